@@ -5,7 +5,7 @@ from test.message import MessageService
 class MessageHandler(MessageService.Iface):   
     def sendSMS(self, mobile):
         try:
-            print mobile
+            print(mobile)
             return True
         except Exception as e:
             raise e  
\ No newline at end of file
@@ -0,0 +1,106 @@
+#-*- coding: utf-8 -*-
+
+'''
+client-side overhead per call, compared with a raw thrift client
+on the same loopback no-op server, and without network by a no-op connection
+
+run: python -m test.bench_client
+'''
+
+import threading
+import time
+
+from thrift.protocol import TCompactProtocol
+from thrift.protocol import TMultiplexedProtocol
+from thrift.server import TServer
+from thrift.TMultiplexedProcessor import TMultiplexedProcessor
+from thrift.transport import TSocket, TTransport
+
+from test.message import MessageService
+from wrpc.client.client import Client
+from wrpc.client.factory import ClientFactory
+from wrpc.manager.provider import FixedProvider
+
+PORT = 19190
+CALLS = 5000
+ROUNDS = 7
+
+class NoopHandler(MessageService.Iface):
+    def sendSMS(self, mobile):
+        return True
+
+class NoopConnection(object):
+    handler = NoopHandler()
+
+    def get_client(self, service_name, timeout=None):
+        return self.handler
+
+    def close(self):
+        pass
+
+class NoopClientFactory(ClientFactory):
+    """connections answering in process, only client-side cost is measured"""
+
+    def __init__(self, provider, ifaces):
+        pass
+
+    def create(self, key, timeout=None):
+        return NoopConnection()
+
+def start_server():
+    processor = TMultiplexedProcessor()
+    processor.registerProcessor("MessageService", MessageService.Processor(NoopHandler()))
+    server = TServer.TThreadedServer(processor, TSocket.TServerSocket("127.0.0.1", PORT),
+                                     TTransport.TFramedTransportFactory(),
+                                     TCompactProtocol.TCompactProtocolFactory(), daemon=True)
+    thread = threading.Thread(target=server.serve)
+    thread.daemon = True
+    thread.start()
+    time.sleep(0.5)
+
+def timeit(func):
+    """best of rounds, loopback latency varies a lot between rounds"""
+    best = None
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        for _ in range(CALLS):
+            func()
+        cost = (time.perf_counter() - start) / CALLS * 1e6
+        best = cost if best is None else min(best, cost)
+    return best
+
+def raw_call():
+    transport = TTransport.TFramedTransport(TSocket.TSocket("127.0.0.1", PORT))
+    protocol = TMultiplexedProtocol.TMultiplexedProtocol(
+                    TCompactProtocol.TCompactProtocol(transport), "MessageService")
+    client = MessageService.Client(protocol)
+    transport.open()
+    return lambda: client.sendSMS("10086")
+
+def run(client, base):
+    service = client.get_client(MessageService)
+    for name, func in (("service.sendSMS()", lambda: service.sendSMS("10086")),
+                       ("client.call(module, name)",
+                        lambda: client.call(MessageService, "sendSMS", "10086")),
+                       ("client.call(module, Iface function)",
+                        lambda: client.call(MessageService, MessageService.Iface.sendSMS, "10086"))):
+        cost = timeit(func)
+        print("%-36s %8.1f %10.1f" % (name, cost, cost - base))
+    client.close()
+
+if __name__ == "__main__":
+    start_server()
+    address = "127.0.0.1:%d" % PORT
+
+    base = timeit(raw_call())
+    print("loopback no-op server")
+    print("%-36s %8s %10s" % ("path", "us/call", "overhead"))
+    print("%-36s %8.1f %10s" % ("raw thrift client", base, "-"))
+    run(Client(FixedProvider(address, [MessageService])), base)
+
+    handler = NoopHandler()
+    base = timeit(lambda: handler.sendSMS("10086"))
+    print("")
+    print("no-op connection")
+    print("%-36s %8.1f %10s" % ("handler", base, "-"))
+    run(Client(FixedProvider(address, [MessageService]), client_class=NoopClientFactory), base)
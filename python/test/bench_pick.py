@@ -0,0 +1,43 @@
+#-*- coding: utf-8 -*-
+
+'''
+node pick throughput of load balances with concurrent threads
+
+run: python -m test.bench_pick
+'''
+
+import threading
+import time
+
+from wrpc.common.node import ServerNode
+from wrpc.manager.load_balance import RandomLoad, RoundRobinLoad, SmoothRoundRobinLoad
+
+PICKS = 200000
+NODES = [ServerNode("10.0.%d.%d:8090:%d" % (i // 250, i % 250, 1 + i % 3)) for i in range(16)]
+
+def run(load_balance, threads):
+    """picks per second of all threads"""
+    per_thread = PICKS // threads
+    barrier = threading.Barrier(threads + 1)
+    def work():
+        get_node = load_balance.get_node
+        barrier.wait()
+        for _ in range(per_thread):
+            get_node()
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return per_thread * threads / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    print("%d nodes, %d picks" % (len(NODES), PICKS))
+    print("%-22s %12s %12s %12s" % ("load balance", "1 thread", "4 threads", "16 threads"))
+    for cls in (RoundRobinLoad, SmoothRoundRobinLoad, RandomLoad):
+        load_balance = cls()
+        load_balance.set_nodes(NODES)
+        print("%-22s %12.0f %12.0f %12.0f" % ((cls.__name__,) +
+                                               tuple(run(load_balance, n) for n in (1, 4, 16))))
@@ -0,0 +1,80 @@
+#-*- coding: utf-8 -*-
+
+'''
+multi-threaded borrow/return benchmark of KeyedObjectPool,
+and connection churn under bursty traffic
+
+run: python -m test.bench_pool
+'''
+
+import threading
+import time
+
+from wrpc.common.pool import KeyedObjectPool
+
+KEYS = ["MessageService", "UserService", "OrderService", "PayService"]
+#模拟建立连接及一次rpc调用的耗时
+CONNECT_COST = 0.005
+CALL_COST = 0.0005
+DURATION = 2
+
+class FakeConnection(object):
+
+    def __init__(self, key):
+        time.sleep(CONNECT_COST)
+        self.key = key
+
+    def close(self):
+        pass
+
+def worker(pool, key, stop, counter, index):
+    n = 0
+    while not stop.is_set():
+        obj = pool.borrow_obj(key)
+        try:
+            time.sleep(CALL_COST)
+        finally:
+            pool.return_obj(obj, key)
+        n += 1
+    counter[index] = n
+
+def run(threads_num):
+    pool = KeyedObjectPool(FakeConnection, pool_max_total=threads_num)
+    stop = threading.Event()
+    counter = [0] * threads_num
+    threads = [threading.Thread(target=worker, args=(pool, KEYS[i % len(KEYS)], stop, counter, i))
+               for i in range(threads_num)]
+    for t in threads:
+        t.start()
+    time.sleep(DURATION)
+    stop.set()
+    for t in threads:
+        t.join()
+    pool.clear()
+    return sum(counter) / float(DURATION)
+
+def burst(pool, size):
+    objs = [pool.borrow_obj(KEYS[0]) for _ in range(size)]
+    for obj in objs:
+        pool.return_obj(obj, KEYS[0])
+
+def run_burst(bursts=20, **kwargs):
+    pool = KeyedObjectPool(FakeConnection, pool_max_total=8, **kwargs)
+    for _ in range(bursts):
+        burst(pool, 8)
+    stats = pool.stats()[KEYS[0]]
+    pool.clear()
+    return stats
+
+if __name__ == "__main__":
+    print("%-8s %-14s %s" % ("threads", "ops/s", "speedup"))
+    base = None
+    for threads_num in (1, 2, 4, 8, 16, 32):
+        ops = run(threads_num)
+        base = base or ops
+        print("%-8d %-14.0f %.2fx" % (threads_num, ops, ops / base))
+
+    print("")
+    print("20 bursts of 8 borrows, created/destroyed connections:")
+    print("max_idle=4: %(created)d/%(destroyed)d" % run_burst(pool_max_idle=4))
+    print("max_idle=8: %(created)d/%(destroyed)d" % run_burst())
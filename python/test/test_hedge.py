@@ -0,0 +1,74 @@
+#-*- coding: utf-8 -*-
+
+'''
+hedged calls from call_async and batch must not deadlock the client executor
+
+run: python -m unittest test.test_hedge
+'''
+
+import threading
+import time
+import unittest
+
+from thrift.server import TServer
+from thrift.protocol import TCompactProtocol
+from thrift.TMultiplexedProcessor import TMultiplexedProcessor
+from thrift.transport import TSocket, TTransport
+
+from test.message import MessageService
+from wrpc.client.client import Client
+from wrpc.manager.provider import FixedProvider
+
+PORTS = (19196, 19197)
+MAX_WORKERS = 4
+
+class SlowHandler(MessageService.Iface):
+    """replies later than the hedge delay so every call is hedged"""
+
+    def sendSMS(self, mobile):
+        time.sleep(0.05)
+        return True
+
+def start_server(port):
+    processor = TMultiplexedProcessor()
+    processor.registerProcessor("MessageService", MessageService.Processor(SlowHandler()))
+    server = TServer.TThreadedServer(processor, TSocket.TServerSocket("127.0.0.1", port),
+                                     TTransport.TFramedTransportFactory(),
+                                     TCompactProtocol.TCompactProtocolFactory(), daemon=True)
+    thread = threading.Thread(target=server.serve)
+    thread.daemon = True
+    thread.start()
+
+class HedgeExecutorTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        for port in PORTS:
+            start_server(port)
+        time.sleep(0.5)
+
+    def setUp(self):
+        address = ",".join("127.0.0.1:%d" % port for port in PORTS)
+        self.client = Client(FixedProvider(address, [MessageService]), max_workers=MAX_WORKERS,
+                             hedges={"MessageService.sendSMS":0.01}, hedge_budget=1)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_call_async(self):
+        futures = [self.client.call_async(MessageService, "sendSMS", "10086")
+                   for _ in range(MAX_WORKERS * 2)]
+        self.assertEqual([future.result(timeout=5) for future in futures],
+                         [True] * (MAX_WORKERS * 2))
+
+    def test_batch(self):
+        calls = [(MessageService, "sendSMS", ("10086",))] * (MAX_WORKERS * 2)
+        results = []
+        thread = threading.Thread(target=lambda: results.extend(self.client.batch(calls)))
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertEqual(results, [True] * (MAX_WORKERS * 2))
+
+if __name__ == "__main__":
+    unittest.main()
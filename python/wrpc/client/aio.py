@@ -0,0 +1,479 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+asyncio client, requests are pipelined on non-blocking framed compact connections
+'''
+from __future__ import absolute_import
+
+import asyncio
+import functools
+import itertools
+import logging
+import struct
+import time
+import types
+
+from thrift.transport.TTransport import TTransportException
+
+from wrpc.common.proxy import Proxy, RoutedProxy
+from wrpc.common import WrpcException, WrpcTimeoutException
+from .pipeline import encode_request, is_oneway, read_seqid, decode_reply
+from .retry import RetryBudget, backoff, select_other, classify, is_unsent
+from .retry import APPLICATION_ERROR, TRANSPORT_ERROR
+from .breaker import CircuitBreaker
+
+logger = logging.getLogger(__name__)
+
+class AsyncClient(object):
+    """asyncio client class"""
+
+    def __init__(self, provider, retry=3, retry_interval=0.2, ready_timeout=10,
+                 share_transport=False, timeout=None, timeouts=None, retry_max_interval=2,
+                 retry_budget=0.1, idempotent=True, idempotents=None, eject_failures=5,
+                 eject_time=30, eject_latency_ratio=None, **kwargs):
+        """
+        asyncio client
+        @param provider: server provider,instance of AutoProvider or FixedProvider class
+        @param retry: retry access times, default is 3
+        @param retry_interval: base retry interval time, doubled every retry with jitter,
+                               default 0.2s
+        @param ready_timeout: max seconds to wait for the first server nodes, default is 10s
+        @param share_transport: services share one connection per node by TMultiplexedProtocol,
+                                default is False
+        @param timeout: deadline seconds of call including connect and retries,
+                        default is None means forever
+        @param timeouts: deadline seconds per service or function as
+                         {"MessageService":1, "MessageService.sendSMS":0.5}, overrides timeout
+        @param retry_max_interval: max retry interval time, default is 2s
+        @param retry_budget: max ratio of retries to calls of the client, None means no limit,
+                             default is 0.1
+        @param idempotent: retry functions after request sent, otherwise only connect failures
+                           are retried, application errors are never retried, default is True
+        @param idempotents: idempotent per service or function as
+                            {"UserService":True, "UserService.create":False}, overrides idempotent
+        @param eject_failures: consecutive transport errors or timeouts to eject a server node
+                               from selection, None means never eject, default is 5
+        @param eject_time: seconds before an ejected node gets a probe call, doubled on every
+                           ejection in a row, default is 30s
+        @param eject_latency_ratio: eject nodes whose average latency is ratio times of the
+                                    median of nodes, default is None means never
+        @param kwargs:
+            pool_shared_size: pipelined connections per service and node, default is 1
+        """
+        self.__provider = provider
+        self.__proxy_map = {}
+        self.__ready_timeout = ready_timeout
+        self.__ready = False
+        self.__retry_budget = RetryBudget(retry_budget) if retry_budget is not None else None
+        self.__breaker = None
+        if eject_failures is not None:
+            self.__breaker = CircuitBreaker(provider, eject_failures, eject_time,
+                                            latency_ratio=eject_latency_ratio)
+
+        service_ifaces = self.__provider.get_services()
+        ifaces = {iface.__name__.split(".")[-1]:iface for iface in service_ifaces}
+        self.__client_pool = AsyncClientPool(ifaces, share_transport, **kwargs)
+        timeouts = timeouts or {}
+        idempotents = idempotents or {}
+        for service_name, iface in ifaces.items():
+            prefix = service_name + "."
+            method_timeouts = {key[len(prefix):]:value for key, value in timeouts.items()
+                               if key.startswith(prefix)}
+            method_idempotents = {key[len(prefix):]:value for key, value in idempotents.items()
+                                  if key.startswith(prefix)}
+            proxy = AsyncClientProxy(service_name, self.__client_pool, provider, retry,
+                                     retry_interval, self.wait_ready,
+                                     timeouts.get(service_name, timeout), method_timeouts,
+                                     retry_max_interval, self.__retry_budget,
+                                     idempotents.get(service_name, idempotent),
+                                     method_idempotents, self.__breaker).bind(iface)
+            self.__proxy_map[service_name] = proxy
+            self.__proxy_map[iface] = proxy
+
+        self.__provider.set_client_pool(self.__client_pool)
+        self.__provider.listen()
+
+    async def wait_ready(self):
+        """wait until server nodes are known, called by the first call"""
+        if self.__ready:
+            return
+        loop = asyncio.get_event_loop()
+        if not await loop.run_in_executor(None, self.__provider.wait_ready, self.__ready_timeout):
+            logger.warning("Server nodes not ready in %s seconds!", self.__ready_timeout)
+        self.__ready = True
+
+    async def close(self):
+        if self.__provider:
+            self.__provider.close()
+        self.__client_pool.close()
+
+    def get_stats(self):
+        """
+        get client statistics
+        @use:
+            stats = client.get_stats()
+            stats["pool"] = {(service name, server node):{"active":n, "in_flight":n}}
+            stats["retry_tokens"] = retry tokens left, None if no retry budget
+            stats["nodes"] = {server node:{"state":"closed", "open" or "half_open",
+                              "failures":n, "latency":seconds, "ejections":n}},
+                              empty if ejection is disabled
+        """
+        budget = self.__retry_budget
+        return {"pool":self.__client_pool.stats(),
+                "retry_tokens":budget.tokens() if budget is not None else None,
+                "nodes":self.__breaker.stats() if self.__breaker is not None else {}}
+
+    def get_client(self, skey, route_key=None):
+        """
+        get service object
+        @param skey: service module or module name
+        @param route_key: routing key of calls by the service object, such as user id,
+                          calls with the same key go to the same node if load balance is
+                          ConsistentHashLoad, default is None
+        @use:
+            service = client.get_client(UserService)
+            user = await service.get(42)
+        """
+        proxy = self.__proxy_map.get(skey)
+        if proxy is None and type(skey) == types.ModuleType:
+            proxy = self.__proxy_map.get(skey.__name__.split(".")[-1])
+        if route_key is not None and proxy is not None:
+            return RoutedProxy(proxy, route_key)
+        return proxy
+
+    async def call(self, skey, fun, *args, **kwargs):
+        '''
+        call service function
+        @param skey: service module or module name
+        @param fun: service function or function name
+        @param args: args of service function
+        @param kwargs:
+            timeout: deadline seconds of this call, overrides configured timeouts
+            route_key: routing key of this call, see get_client
+        @use:
+            result = await client.call("MessageService", "sendSMS", '10086', timeout=0.5)
+        '''
+        client_proxy = self.get_client(skey)
+        func_name = fun.__name__ if callable(fun) else fun
+        return await client_proxy.call(func_name, *args, **kwargs)
+
+    def get_func(self, skey, fun):
+        """
+        get coroutine function object
+        @param skey: service module or module name
+        @param fun: service function or function name
+        @use:
+            func = client.get_func(MessageService, MessageService.Iface.sendSMS)
+            result = await func('10086')
+        """
+        return functools.partial(self.call, skey, fun)
+
+class AsyncClientPool(object):
+    """
+    asyncio connection pool, keyed by (service name, server node) or server node if transport is shared,
+    every key has up to pool_shared_size pipelined connections used round robin
+    """
+
+    def __init__(self, ifaces, share_transport=False, **kwargs):
+        self.share_transport = share_transport
+        self.max_size = kwargs.get("pool_shared_size", 1)
+        self.__ifaces = ifaces
+        self.__pool_map = {} # {key:[AsyncConnection]}
+        self.__locks = {}
+        self.__pos = itertools.count()
+        self.__loop = None
+
+    def get_key(self, service_name, node):
+        return node if self.share_transport else (service_name, node)
+
+    async def borrow(self, key):
+        conns = self.__pool_map.get(key)
+        if conns and (len(conns) >= self.max_size or self.__locks[key].locked()):
+            conn = conns[next(self.__pos) % len(conns)]
+            if conn.is_open():
+                return conn
+
+        self.__loop = asyncio.get_event_loop()
+        lock = self.__locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            conns = [conn for conn in self.__pool_map.get(key, []) if conn.is_open()]
+            if len(conns) < self.max_size:
+                node = key if not isinstance(key, tuple) else key[1]
+                conn = AsyncConnection(node, self.__ifaces)
+                await conn.open()
+                conns.append(conn)
+                logger.info("Client created for %s.", node)
+            else:
+                conn = conns[next(self.__pos) % len(conns)]
+            self.__pool_map[key] = conns
+            return conn
+
+    def destroy(self, conn, key):
+        conns = self.__pool_map.get(key)
+        if conns and conn in conns:
+            self.__pool_map[key] = [c for c in conns if c is not conn]
+        conn.close()
+
+    def __call_in_loop(self, func, *args):
+        #provider calls from zookeeper thread
+        loop = self.__loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(func, *args)
+        else:
+            func(*args)
+
+    def __remove_nodes(self, nodes):
+        for key in list(self.__pool_map):
+            node = key if self.share_transport else key[1]
+            if node in nodes:
+                for conn in self.__pool_map.pop(key):
+                    conn.close()
+
+    def remove_nodes(self, nodes):
+        """
+        close connections to removed server nodes
+        @param nodes: server nodes
+        """
+        self.__call_in_loop(self.__remove_nodes, set(nodes))
+        logger.info("Client pool removed nodes: %s.", list(nodes))
+
+    def __clear(self):
+        pool_map, self.__pool_map = self.__pool_map, {}
+        for conns in pool_map.values():
+            for conn in conns:
+                conn.close()
+
+    def clear_pool(self):
+        self.__call_in_loop(self.__clear)
+        logger.info("Client pool cleared.")
+
+    def close(self):
+        self.__clear()
+
+    def stats(self):
+        return {key:{"active":len(conns), "in_flight":sum(conn.in_flight() for conn in conns)}
+                for key, conns in list(self.__pool_map.items())}
+
+class AsyncConnection(object):
+    """
+    non-blocking framed compact connection,
+    requests are tagged by seqid and replies are dispatched to callers as they arrive
+    """
+
+    def __init__(self, server_node, ifaces):
+        """
+        @param server_node: server node
+        @param ifaces: ifaces map as {iface name: iface class}
+        """
+        self.server_node = server_node
+        self.__ifaces = ifaces
+        self.__seqids = itertools.count(1)
+        #{seqid:future}
+        self.__pending = {}
+        self.__reader = None
+        self.__writer = None
+        self.__read_task = None
+        self.__closed = True
+
+    async def open(self):
+        try:
+            self.__reader, self.__writer = await asyncio.open_connection(self.server_node.address,
+                                                                         self.server_node.port)
+        except OSError as e:
+            raise TTransportException(TTransportException.NOT_OPEN,
+                                      "Could not connect to %s: %s" % (self.server_node, e))
+        self.__closed = False
+        self.__read_task = asyncio.ensure_future(self.__read_loop())
+
+    def is_open(self):
+        return not self.__closed
+
+    def in_flight(self):
+        return len(self.__pending)
+
+    async def invoke(self, service_name, fun, *args):
+        """
+        send request and wait for its reply
+        @param service_name: service name
+        @param fun: function name
+        @param args: args of service function
+        """
+        client_class = getattr(self.__ifaces.get(service_name), "Client")
+        if not hasattr(client_class, "send_" + fun):
+            raise WrpcException("Unknown method!")
+        if self.__closed:
+            raise TTransportException(TTransportException.NOT_OPEN, "Connection closed")
+
+        seqid = next(self.__seqids) & 0x7fffffff
+        client, frame = encode_request(service_name, client_class, fun, args, seqid)
+        #oneway function has no reply
+        future = None
+        if not is_oneway(client, fun):
+            future = asyncio.get_event_loop().create_future()
+            self.__pending[seqid] = future
+
+        self.__writer.write(frame)
+        try:
+            await self.__writer.drain()
+        except Exception as e:
+            self.__fail(e)
+            raise TTransportException(TTransportException.END_OF_FILE, str(e))
+
+        if future is None:
+            return None
+        try:
+            payload = await future
+        finally:
+            self.__pending.pop(seqid, None)
+        return decode_reply(client, fun, payload)
+
+    async def __read_loop(self):
+        try:
+            while True:
+                size, = struct.unpack("!i", await self.__reader.readexactly(4))
+                payload = await self.__reader.readexactly(size)
+                future = self.__pending.pop(read_seqid(payload), None)
+                if future is not None and not future.done():
+                    future.set_result(payload)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            if not self.__closed:
+                logger.warning("Connection to %s broken: %s", self.server_node, e)
+            self.__fail(e)
+
+    def __fail(self, e):
+        self.__closed = True
+        pending, self.__pending = self.__pending, {}
+        if not isinstance(e, TTransportException):
+            e = TTransportException(TTransportException.END_OF_FILE, str(e))
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(e)
+        if self.__writer is not None:
+            self.__writer.close()
+
+    def close(self):
+        #请求可能已发出，不能用NOT_OPEN，否则非幂等方法会被当作未发出而重试
+        self.__fail(TTransportException(TTransportException.END_OF_FILE, "Connection closed"))
+        if self.__read_task is not None:
+            self.__read_task.cancel()
+        logger.info("Client closed.")
+
+class AsyncClientProxy(Proxy):
+    '''asyncio client proxy class, service functions return awaitables'''
+
+    def __init__(self, service_name, pool, provider, retry, retry_interval, wait_ready,
+                 timeout=None, method_timeouts=None, retry_max_interval=2, retry_budget=None,
+                 idempotent=True, method_idempotents=None, breaker=None):
+        '''
+        @param service_name: service name
+        @param pool: asyncio client pool
+        @param provider: server provider, selects server node for every call
+        @param retry: retry access times, default is 3
+        @param retry_interval: base retry interval time, default 0.2s
+        @param wait_ready: coroutine function waiting for server nodes
+        @param timeout: deadline seconds of call, default is None means forever
+        @param method_timeouts: deadline seconds per function as {function name:seconds}
+        @param retry_max_interval: max retry interval time, default is 2s
+        @param retry_budget: RetryBudget shared by the client, None means no limit
+        @param idempotent: retry functions after request sent, default is True
+        @param method_idempotents: idempotent per function as {function name:bool}
+        @param breaker: CircuitBreaker shared by the client, None means no ejection
+        '''
+        self.service_name = service_name
+        self.pool = pool
+        self.provider = provider
+        self.retry = retry
+        self.retry_interval = retry_interval
+        self.wait_ready = wait_ready
+        self.timeout = timeout
+        self.method_timeouts = method_timeouts or {}
+        self.retry_max_interval = retry_max_interval
+        self.retry_budget = retry_budget
+        self.idempotent = idempotent
+        self.method_idempotents = method_idempotents or {}
+        self.breaker = breaker
+
+    async def call(self, fun, *args, **kwargs):
+        '''
+        @param fun: function name
+        @param args: args of service function
+        @param kwargs:
+            timeout: deadline seconds of this call
+            route_key: routing key of this call, selects node of the first attempt
+        '''
+        await self.wait_ready()
+        timeout = kwargs.get("timeout", self.method_timeouts.get(fun, self.timeout))
+        if timeout is None:
+            return await self.__call(fun, args, kwargs.get("route_key"))
+        try:
+            return await asyncio.wait_for(self.__call(fun, args, kwargs.get("route_key")), timeout)
+        except asyncio.TimeoutError:
+            raise WrpcTimeoutException("Call timeout!")
+
+    async def __call(self, fun, args, route_key=None):
+        exception = None
+        provider = self.provider
+        budget = self.retry_budget
+        breaker = self.breaker
+        if budget is not None:
+            budget.deposit()
+        tried = None
+        for attempt in range(self.retry):
+            if attempt > 0:
+                if budget is not None and not budget.withdraw():
+                    break
+                await asyncio.sleep(backoff(attempt - 1, self.retry_interval, self.retry_max_interval))
+            conn = node = None
+            try:
+                if route_key is not None and tried is None:
+                    node = provider.select(route_key)
+                    if breaker is not None and not breaker.allow(node):
+                        node = breaker.select(tried)
+                elif breaker is not None:
+                    node = breaker.select(tried)
+                else:
+                    node = provider.select() if tried is None else select_other(provider, tried)
+                provider.start(node)
+                selected = time.monotonic()
+                key = self.pool.get_key(self.service_name, node)
+                conn = await self.pool.borrow(key)
+                start = time.monotonic()
+                result = await conn.invoke(self.service_name, fun, *args)
+                provider.finish(node, time.monotonic() - selected)
+                if breaker is not None:
+                    breaker.success(node, time.monotonic() - start)
+                return result
+            except asyncio.CancelledError:
+                #wait_for超时取消的调用计为节点超时
+                if node is not None:
+                    provider.finish(node, time.monotonic() - selected, True)
+                if breaker is not None and conn is not None:
+                    breaker.failure(node)
+                raise
+            except Exception as e:
+                exception = e
+                error = classify(e)
+                if node is not None:
+                    provider.finish(node, time.monotonic() - selected, error != APPLICATION_ERROR)
+                if breaker is not None and node is not None:
+                    if error == APPLICATION_ERROR:
+                        if conn is not None:
+                            breaker.success(node, time.monotonic() - start)
+                    elif conn is not None or error == TRANSPORT_ERROR:
+                        breaker.failure(node)
+                if error == APPLICATION_ERROR:
+                    raise
+                if conn is not None and isinstance(e, TTransportException):
+                    self.pool.destroy(conn, key)
+                logger.error("Could not connect server!")
+                #请求已发出时只重试幂等方法
+                if (conn is not None and not is_unsent(e)
+                    and not self.method_idempotents.get(fun, self.idempotent)):
+                    raise
+
+            tried = tried or set()
+            tried.add(node)
+        raise exception
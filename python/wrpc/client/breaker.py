@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+per node circuit breaker, ejects failing or slow server nodes from selection
+and lets them back after a successful probe
+'''
+
+import threading
+import time
+
+from .retry import SELECT_ATTEMPTS
+
+#节点状态
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+#计算延迟离群时每个节点至少需要的样本数
+MIN_SAMPLES = 20
+#延迟平均值的平滑系数
+EWMA_ALPHA = 0.1
+
+class NodeState(object):
+    """health of a server node"""
+
+    __slots__ = ("state", "failures", "latency", "samples", "ejections", "until", "probing")
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.latency = None
+        self.samples = 0
+        self.ejections = 0
+        self.until = 0
+        self.probing = 0
+
+class CircuitBreaker(object):
+    """
+    circuit breaker of server nodes shared by all services of a client,
+    a node is ejected after consecutive failures or when its average latency is
+    latency_ratio times of the median of other nodes, an ejected node gets one probe call
+    after eject_time, which is doubled on every ejection in a row
+    """
+
+    def __init__(self, provider, failures=5, eject_time=30, max_eject_time=300,
+                 max_eject_ratio=0.5, latency_ratio=None):
+        """
+        @param provider: server provider
+        @param failures: consecutive transport errors or timeouts to eject a node, default is 5
+        @param eject_time: seconds a node is ejected at first, default is 30s
+        @param max_eject_time: max seconds a node is ejected, default is 300s
+        @param max_eject_ratio: max ratio of nodes ejected at the same time, default is 0.5
+        @param latency_ratio: eject slow nodes whose latency is latency_ratio times of
+                              the median, default is None means never eject for latency
+        """
+        self.provider = provider
+        self.failures = failures
+        self.eject_time = eject_time
+        self.max_eject_time = max_eject_time
+        self.max_eject_ratio = max_eject_ratio
+        self.latency_ratio = latency_ratio
+        self.__states = {}
+        self.__lock = threading.Lock()
+
+    def select(self, tried=None):
+        """
+        select server node not ejected and not tried by this call,
+        falls back to any node if all of them are ejected
+        @param tried: nodes failed in this call
+        """
+        node = None
+        for _ in range(SELECT_ATTEMPTS):
+            node = self.provider.select()
+            if (not tried or node not in tried) and self.allow(node):
+                return node
+        return node
+
+    def allow(self, node):
+        """return True if the node may be called, ejected node is allowed one probe call"""
+        state = self.__states.get(node)
+        if state is None or state.state == CLOSED:
+            return True
+        now = time.monotonic()
+        with self.__lock:
+            if now < state.until:
+                return False
+            #探测超时未返回结果时允许新的探测
+            if state.state == HALF_OPEN and now < state.probing + self.eject_time:
+                return False
+            state.state = HALF_OPEN
+            state.probing = now
+            return True
+
+    def success(self, node, latency):
+        """
+        report a successful call, application errors are successes too
+        @param latency: seconds of the call
+        """
+        with self.__lock:
+            #新节点的状态在锁内加入，__is_slow及__eject遍历时字典不会改变
+            state = self.__states.get(node)
+            if state is None:
+                state = self.__states[node] = NodeState()
+            state.failures = 0
+            if state.state != CLOSED:
+                state.state = CLOSED
+                state.ejections = 0
+                state.latency = None
+                state.samples = 0
+            state.latency = latency if state.latency is None else \
+                            state.latency + EWMA_ALPHA * (latency - state.latency)
+            state.samples += 1
+            if self.latency_ratio is not None and state.samples % MIN_SAMPLES == 0 \
+                and self.__is_slow(node, state):
+                self.__eject(node, state)
+
+    def failure(self, node):
+        """report a transport error or timeout of the node"""
+        with self.__lock:
+            state = self.__states.get(node)
+            if state is None:
+                state = self.__states[node] = NodeState()
+            state.failures += 1
+            if state.state == HALF_OPEN or \
+                (state.state == CLOSED and state.failures >= self.failures):
+                self.__eject(node, state)
+
+    def __is_slow(self, node, state):
+        latencies = sorted(other.latency for key, other in self.__states.items()
+                           if key != node and other.state == CLOSED
+                           and other.samples >= MIN_SAMPLES)
+        if not latencies:
+            return False
+        return state.latency > latencies[len(latencies) // 2] * self.latency_ratio
+
+    def __eject(self, node, state):
+        nodes = set(self.provider.get_nodes())
+        #清理已下线节点的状态
+        for key in [key for key in self.__states if key not in nodes]:
+            del self.__states[key]
+        ejected = sum(1 for other in self.__states.values() if other.state != CLOSED)
+        if state.state == CLOSED and ejected + 1 > len(nodes) * self.max_eject_ratio:
+            return
+        state.state = OPEN
+        state.until = time.monotonic() + min(self.eject_time * (2 ** state.ejections),
+                                             self.max_eject_time)
+        state.ejections += 1
+        state.failures = 0
+
+    def stats(self):
+        """
+        @return: {server node:{"state":state, "failures":n, "latency":seconds, "ejections":n}}
+        """
+        with self.__lock:
+            return {node:{"state":state.state, "failures":state.failures,
+                          "latency":state.latency, "ejections":state.ejections}
+                    for node, state in self.__states.items()}
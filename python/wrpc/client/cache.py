@@ -0,0 +1,152 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+client-side result cache of idempotent functions,
+keyed on the serialized args struct of the function
+'''
+
+from collections import OrderedDict
+import threading
+import time
+
+from thrift.TSerialization import serialize
+from thrift.protocol import TCompactProtocol
+
+#缓存查询结果
+MISS = 0
+FRESH = 1
+STALE = 2
+
+PROTOCOL_FACTORY = TCompactProtocol.TCompactProtocolFactory()
+
+def make_key(args_class, args):
+    """serialize args of call by the generated args struct of function as key"""
+    return serialize(args_class(*args), PROTOCOL_FACTORY)
+
+class CacheEntry(object):
+
+    __slots__ = ("value", "size", "expire", "refreshing")
+
+    def __init__(self, value, size, expire):
+        self.value = value
+        self.size = size
+        self.expire = expire
+        self.refreshing = False
+
+class ResultCache(object):
+    """
+    LRU cache of one service function bounded by entries and bytes,
+    entries are fresh in ttl and may be served stale for stale_ttl more seconds
+    while one caller refreshes them, cached results are shared and must not be modified
+    """
+
+    def __init__(self, args_class, result_class, ttl, max_entries=1000, max_bytes=None,
+                 stale_ttl=0):
+        """
+        @param args_class: generated args struct of the function, such as UserService.get_args
+        @param result_class: generated result struct of the function, such as UserService.get_result
+        @param ttl: seconds a result is fresh
+        @param max_entries: max results cached, default is 1000
+        @param max_bytes: max serialized bytes of keys and results, default is None means no limit
+        @param stale_ttl: seconds an expired result is still served while refreshed,
+                          default is 0
+        """
+        self.args_class = args_class
+        self.result_class = result_class
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale_ttl = stale_ttl
+        self.__entries = OrderedDict()
+        self.__bytes = 0
+        self.__hits = 0
+        self.__misses = 0
+        #失效时递增，失效前发出的调用结果不再写入缓存
+        self.generation = 0
+        self.__lock = threading.Lock()
+
+    def make_key(self, args):
+        """serialize args of call as cache key"""
+        return make_key(self.args_class, args)
+
+    def get(self, key):
+        """
+        @return: (value, MISS, FRESH or STALE)
+        """
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                if now < entry.expire:
+                    self.__entries.move_to_end(key)
+                    self.__hits += 1
+                    return entry.value, FRESH
+                if now < entry.expire + self.stale_ttl:
+                    self.__entries.move_to_end(key)
+                    self.__hits += 1
+                    return entry.value, STALE
+                self.__remove(key)
+            self.__misses += 1
+            return None, MISS
+
+    def revalidate(self, key):
+        """return True if the caller should refresh the stale result, only one caller does"""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or entry.refreshing:
+                return False
+            entry.refreshing = True
+            return True
+
+    def revalidate_failed(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                entry.refreshing = False
+
+    def put(self, key, value, generation):
+        """
+        cache result of call
+        @param generation: generation when the call started, result is dropped if invalidated since
+        """
+        size = 0
+        if self.max_bytes is not None:
+            size = len(key)
+            if value is not None:
+                size += len(serialize(self.result_class(value), PROTOCOL_FACTORY))
+            if size > self.max_bytes:
+                return
+        with self.__lock:
+            if generation != self.generation:
+                return
+            if key in self.__entries:
+                self.__remove(key)
+            self.__entries[key] = CacheEntry(value, size, time.monotonic() + self.ttl)
+            self.__bytes += size
+            while len(self.__entries) > self.max_entries or \
+                (self.max_bytes is not None and self.__bytes > self.max_bytes):
+                self.__remove(next(iter(self.__entries)))
+
+    def __remove(self, key):
+        self.__bytes -= self.__entries.pop(key).size
+
+    def invalidate(self, key=None):
+        """
+        remove cached result
+        @param key: key of args, default is None means all results
+        """
+        with self.__lock:
+            self.generation += 1
+            if key is None:
+                self.__entries.clear()
+                self.__bytes = 0
+            elif key in self.__entries:
+                self.__remove(key)
+
+    def stats(self):
+        """
+        @return: {"entries":n, "bytes":n, "hits":n, "misses":n}
+        """
+        return {"entries":len(self.__entries), "bytes":self.__bytes,
+                "hits":self.__hits, "misses":self.__misses}
@@ -7,17 +7,24 @@ Created on 2017年3月4日
 '''
 from __future__ import absolute_import
 
+from collections import deque
 import functools
+import inspect
 import logging
+import threading
 import time
 import types
 
-from thrift.transport.TTransport import TTransportException
-from wrpc.common.proxy import Proxy
-from wrpc.common.pool import KeyedObjectPool
-from wrpc.common import WrpcException
+from wrpc.common.proxy import Proxy, RoutedProxy
+from wrpc.common import WrpcException, WrpcTimeoutException
 
 from .factory import ThriftClientFactory
+from .retry import RetryBudget, backoff, select_other, classify, is_reusable, is_unsent
+from .retry import APPLICATION_ERROR, TIMEOUT_ERROR, TRANSPORT_ERROR
+from .hedge import HedgePolicy
+from .breaker import CircuitBreaker
+from .cache import ResultCache, FRESH, STALE
+from .flight import SingleFlight
 
 logger = logging.getLogger(__name__)
 
@@ -25,58 +32,231 @@ class Client(object):
     """client class"""
     
     def __init__(self, provider, client_class=ThriftClientFactory, 
-                 retry=3, retry_interval=0.2, **kwargs):
+                 retry=3, retry_interval=0.2, ready_timeout=10, prewarm_size=0, 
+                 share_transport=False, max_workers=32, timeout=None, timeouts=None, 
+                 propagate_deadline=False, retry_max_interval=2, retry_budget=0.1, 
+                 idempotent=True, idempotents=None, hedges=None, hedge_budget=0.1, 
+                 eject_failures=5, eject_time=30, eject_latency_ratio=None, caches=None, 
+                 cache_max_entries=1000, cache_max_bytes=None, cache_stale_ttl=0, coalesces=None, 
+                 **kwargs):
         """
         client 
         @param provider: server provider,instance of AutoProvider or FixedProvider class
-        @param client_class: child class of ClientFactory, default is ThriftClientFactory
+        @param client_class: child class of ClientFactory, default is ThriftClientFactory,
+                             GeventClientFactory for greenlets without monkey patching
         @param retry: retry access times, default is 3
-        @param retry_interval: retry interval time, default 0.2s
+        @param retry_interval: base retry interval time, doubled every retry with jitter, 
+                               default 0.2s
+        @param ready_timeout: max seconds to wait for the first server nodes, default is 10s
+        @param prewarm_size: connections opened per service and node before the first call, 
+                             default is 0
+        @param share_transport: services share one connection per node by TMultiplexedProtocol,
+                                pool sizes are per node then, default is False
+        @param max_workers: max concurrent calls of batch and call_async, default is 32
+        @param timeout: deadline seconds of call including pool wait, connect, read and retries,
+                        default is None means forever
+        @param timeouts: deadline seconds per service or function as 
+                         {"MessageService":1, "MessageService.sendSMS":0.5}, overrides timeout
+        @param propagate_deadline: send remaining time of call to server,
+                                   server drops expired requests, default is False
+        @param retry_max_interval: max retry interval time, default is 2s
+        @param retry_budget: max ratio of retries to calls of the client, None means no limit,
+                             default is 0.1
+        @param idempotent: retry functions after request sent, otherwise only connect failures 
+                           are retried, application errors are never retried, default is True
+        @param idempotents: idempotent per service or function as 
+                            {"UserService":True, "UserService.create":False}, overrides idempotent
+        @param hedges: hedged services or functions of idempotent reads as 
+                       {"UserService.get":0.05, "UserService.find":"p95"}, a duplicate request is 
+                       sent to another node if no reply in the delay seconds or the percentile 
+                       of recent latencies, the first reply wins, default is None means no hedging
+        @param hedge_budget: max ratio of hedged requests to calls, default is 0.1
+        @param eject_failures: consecutive transport errors or timeouts to eject a server node 
+                               from selection, None means never eject, default is 5
+        @param eject_time: seconds before an ejected node gets a probe call, doubled on every 
+                           ejection in a row, default is 30s
+        @param eject_latency_ratio: eject nodes whose average latency is ratio times of the 
+                                    median of nodes, default is None means never
+        @param caches: cached services or functions of idempotent reads as {"UserService.get":60},
+                       results are cached for the ttl seconds by args, hits do not call server,
+                       default is None means no cache
+        @param cache_max_entries: max results cached per function, default is 1000
+        @param cache_max_bytes: max serialized bytes of args and results cached per function, 
+                                default is None means no limit
+        @param cache_stale_ttl: seconds an expired result is still returned while one call 
+                                refreshes it in background, default is 0
+        @param coalesces: coalesced services or functions of idempotent reads as 
+                          {"UserService":True, "UserService.create":False}, callers wait for 
+                          the reply of a call in flight with the same args instead of sending 
+                          another request, default is None means no coalescing
         @param kwargs: 
-            pool_max_size: client pool max size, default is 8    
+            pool_max_total: max connections per service and node, default is 8    
+            pool_max_idle: max idle connections per service and node, default is pool_max_total
             pool_wait_timeout: client pool block time, default is None means forever      
+            pool_min_idle: min idle connections per service and node, default is 0
+            pool_max_idle_time: idle seconds before connection closed, default is None means never
+            pool_max_lifetime: lifetime seconds of connection, default is None means forever
+            pool_test_on_borrow: check connection before borrowed, default is False
+            pool_test_while_idle: check idle connections by evictor, default is False
+            pool_eviction_interval: evictor run interval seconds, default is 30
+            pool_shared_size: connections per service and node if client_class is 
+                              PipelinedClientFactory, default is 1
         """
         self.__provider = provider
         self.__proxy_map = {}
+        self.__max_workers = max_workers
+        self.__executor = None
+        self.__hedge_executor = None
+        self.__executor_lock = threading.Lock()
+        self.__retry_budget = RetryBudget(retry_budget) if retry_budget is not None else None
+        self.__hedge_budget = RetryBudget(hedge_budget) if hedges else None
+        self.__breaker = None
+        if eject_failures is not None:
+            self.__breaker = CircuitBreaker(provider, eject_failures, eject_time, 
+                                            latency_ratio=eject_latency_ratio)
 
-        self.__set_client_pool(client_class, **kwargs)  
-        self.__add_client_proxy(retry, retry_interval)     
-        self.__listen()
+        self.__set_client_pool(client_class, share_transport, timeout, propagate_deadline, **kwargs)  
+        self.__add_client_proxy(retry, retry_interval, retry_max_interval, timeout, timeouts or {}, 
+                                idempotent, idempotents or {}, hedges or {}, caches or {},
+                                {"max_entries":cache_max_entries, "max_bytes":cache_max_bytes,
+                                 "stale_ttl":cache_stale_ttl}, coalesces or {})     
+        self.__listen(ready_timeout)
+        self.__prewarm(prewarm_size)
             
-    def __set_client_pool(self, client_class, **kwargs):
+    def __set_client_pool(self, client_class, share_transport, timeout, propagate_deadline, **kwargs):
         service_ifaces = self.__provider.get_services()
         ifaces = {iface.__name__.split(".")[-1]:iface for iface in service_ifaces}
         client_factory = client_class(self.__provider, ifaces)   
-        self.__client_pool = ClientPool(client_factory, **kwargs)     
+        #预热及evictor创建连接时没有调用的deadline，以timeout作为连接超时
+        client_factory.connect_timeout = timeout
+        client_factory.propagate_deadline = propagate_deadline
+        self.__client_pool = ClientPool(client_factory, share_transport, **kwargs)     
         
-    def __add_client_proxy(self, retry, retry_interval):   
+    def __add_client_proxy(self, retry, retry_interval, retry_max_interval, timeout, timeouts, 
+                           idempotent, idempotents, hedges, caches, cache_options, coalesces):   
         service_ifaces = self.__provider.get_services()
         pool = self.__client_pool
+        provider = self.__provider
+        event_class = pool.client_factory.event_class
         for iface in service_ifaces:
             service_name = iface.__name__.split(".")[-1]
-            self.__proxy_map[service_name] = ClientProxy(service_name, pool, retry, retry_interval)     
+            prefix = service_name + "."
+            method_timeouts = {key[len(prefix):]:value for key, value in timeouts.items() 
+                               if key.startswith(prefix)}
+            method_idempotents = {key[len(prefix):]:value for key, value in idempotents.items() 
+                                  if key.startswith(prefix)}
+            method_hedges = {key[len(prefix):]:value for key, value in hedges.items() 
+                             if key.startswith(prefix)}
+            method_caches, method_flights = {}, {}
+            for name, _ in inspect.getmembers(iface.Iface, inspect.isfunction):
+                ttl = caches.get(prefix + name, caches.get(service_name))
+                if ttl is not None:
+                    method_caches[name] = ResultCache(getattr(iface, name + "_args"), 
+                                                      getattr(iface, name + "_result"), 
+                                                      ttl, **cache_options)
+                if coalesces.get(prefix + name, coalesces.get(service_name)):
+                    method_flights[name] = SingleFlight(getattr(iface, name + "_args"), event_class)
+            proxy = ClientProxy(service_name, pool, provider, retry, retry_interval,
+                                timeouts.get(service_name, timeout), method_timeouts,
+                                retry_max_interval, self.__retry_budget,
+                                idempotents.get(service_name, idempotent), method_idempotents,
+                                hedges.get(service_name), method_hedges, 
+                                self.__hedge_budget, self.get_executor, self.__get_hedge_executor,
+                                self.__breaker, method_caches, method_flights).bind(iface)
+            #服务模块及服务名都可以查到proxy，调用时不再解析模块名
+            self.__proxy_map[service_name] = proxy
+            self.__proxy_map[iface] = proxy
 
-    def __listen(self):    
+    def __listen(self, ready_timeout):    
         self.__provider.set_client_pool(self.__client_pool)
         self.__provider.listen()
-        time.sleep(1)
+        if not self.__provider.wait_ready(ready_timeout):
+            logger.warning("Server nodes not ready in %s seconds!", ready_timeout)
+        
+    def __prewarm(self, prewarm_size):
+        if prewarm_size <= 0:
+            return
+        
+        client_pool = self.__client_pool
+        pool = client_pool.get_pool()
+        def prepare(key):
+            try:
+                pool.prepare(key, prewarm_size)
+            except Exception as e:
+                logger.warning("Prewarm %s error: %s", key, e)
+        
+        #connect to all nodes concurrently
+        keys = set(client_pool.get_key(proxy.service_name, node) 
+                   for node in self.__provider.get_nodes() for proxy in self.__proxy_map.values())
+        client_pool.client_factory.run_all(prepare, [(key,) for key in keys])
+        logger.info("Client pool prewarmed.")
         
     def close(self):
         if self.__provider:
             self.__provider.close()   
+        for executor in (self.__executor, self.__hedge_executor):
+            if executor is not None:
+                executor.shutdown(wait=False)
+        self.__client_pool.close()
 
-    def get_client(self, skey):
+    def get_stats(self):
+        """
+        get client statistics
+        @use:
+            stats = client.get_stats()
+            stats["pool"] = {(service name, server node):{"active":n, "idle":n, "created":n, "destroyed":n}}
+            stats["retry_tokens"] = retry tokens left, None if no retry budget
+            stats["hedge_tokens"] = hedge tokens left, None if no hedging
+            stats["nodes"] = {server node:{"state":"closed", "open" or "half_open", 
+                              "failures":n, "latency":seconds, "ejections":n}}, 
+                              empty if ejection is disabled
+            stats["caches"] = {(service name, function name):{"entries":n, "bytes":n, 
+                               "hits":n, "misses":n}}
+            stats["flights"] = {(service name, function name):{"in_flight":n, "coalesced":n}}
+        """
+        budget, hedge_budget = self.__retry_budget, self.__hedge_budget
+        return {"pool":self.__client_pool.stats(), 
+                "retry_tokens":budget.tokens() if budget is not None else None,
+                "hedge_tokens":hedge_budget.tokens() if hedge_budget is not None else None,
+                "nodes":self.__breaker.stats() if self.__breaker is not None else {},
+                "caches":{(proxy.service_name, fun):cache.stats() 
+                          for skey, proxy in self.__proxy_map.items() if isinstance(skey, str)
+                          for fun, cache in proxy.caches.items()},
+                "flights":{(proxy.service_name, fun):flight.stats() 
+                           for skey, proxy in self.__proxy_map.items() if isinstance(skey, str)
+                           for fun, flight in proxy.flights.items()}}
+
+    def get_client(self, skey, route_key=None):
         """
         get service object
         @param skey: service module or module name
+        @param route_key: routing key of calls by the service object, such as user id, 
+                          calls with the same key go to the same node if load balance is 
+                          ConsistentHashLoad, default is None
         @use:
             service = client.get_client('MessageService') ||
             service = client.get_client(MessageService)
             
             result = service.sendSMS('10086')
+            user = client.get_client(UserService, route_key=uid).get(uid)
         """  
-        key = skey.__name__.split(".")[-1] if type(skey) == types.ModuleType else skey
-        return self.__proxy_map.get(key)
+        proxy = self.__proxy_map.get(skey)
+        if proxy is None and type(skey) == types.ModuleType:
+            proxy = self.__proxy_map.get(skey.__name__.split(".")[-1])
+        if route_key is not None and proxy is not None:
+            return RoutedProxy(proxy, route_key)
+        return proxy
+        
+    def invalidate(self, skey, fun=None, *args):
+        """
+        remove cached results
+        @param skey: service module or module name
+        @param fun: service function or function name, default is None means all functions
+        @param args: args of the cached call, default is empty means all results of function
+        @use:
+            client.invalidate(UserService, "get", 42)
+        """
+        self.get_client(skey).invalidate(fun.__name__ if callable(fun) else fun, *args)
         
     def __call__(self, skey, fun, *args):
         '''
@@ -90,20 +270,45 @@ class Client(object):
         '''         
         return self.call(skey, fun, *args)
     
-    def call(self, skey, fun, *args):
+    def call(self, skey, fun, *args, **kwargs):
         '''
         call service function
         @param skey: service module or module name
         @param fun: service function or function name
         @param args: args of service function  
+        @param kwargs:
+            timeout: deadline seconds of this call, overrides configured timeouts
+            route_key: routing key of this call, see get_client
         @use:
             result = client.call("MessageService", "sendSMS", '10086') ||
-            result = client.call(MessageService, MessageService.Iface.sendSMS, '10086')    
+            result = client.call(MessageService, MessageService.Iface.sendSMS, '10086', timeout=0.5)    
         '''        
         client_proxy = self.get_client(skey)
         func_name = fun.__name__ if callable(fun) else fun
-        func = getattr(client_proxy, func_name)
-        return func(*args)
+        #不经过属性查找，与proxy属性同名的函数也可以调用
+        return client_proxy.call(func_name, *args, **kwargs)
+
+    def call_async(self, skey, fun, *args, **kwargs):
+        '''
+        call service function in client executor
+        @param skey: service module or module name
+        @param fun: service function or function name
+        @param args: args of service function  
+        @param kwargs:
+            timeout: deadline seconds of this call, overrides configured timeouts
+            callback: function called with the future when the call is done
+        @return: concurrent.futures.Future of the result
+        @use:
+            user_future = client.call_async(UserService, "get", 42)
+            msg_future = client.call_async(MessageService, "sendSMS", '10086', 
+                                           callback=lambda future: future.exception())
+            user, msg = user_future.result(), msg_future.result()
+        '''
+        callback = kwargs.pop("callback", None)
+        future = self.get_executor().submit(self.call, skey, fun, *args, **kwargs)
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
 
     def get_func(self, skey, fun):
         """
@@ -118,65 +323,369 @@ class Client(object):
         """
         return functools.partial(self.call, skey, fun)
     
+    def get_executor(self):
+        """executor of concurrent calls, created by client factory on first use"""
+        if self.__executor is None:
+            with self.__executor_lock:
+                if self.__executor is None:
+                    factory = self.__client_pool.client_factory
+                    self.__executor = factory.create_executor(self.__max_workers)
+        return self.__executor
+    
+    def __get_hedge_executor(self):
+        #对冲请求使用独立的executor，call_async及batch占满executor时等待对冲结果不会死锁
+        if self.__hedge_executor is None:
+            with self.__executor_lock:
+                if self.__hedge_executor is None:
+                    factory = self.__client_pool.client_factory
+                    self.__hedge_executor = factory.create_executor(self.__max_workers)
+        return self.__hedge_executor
+    
+    def batch(self, calls, concurrency=None, timeout=None):
+        """
+        call service functions concurrently
+        @param calls: list of (skey, fun, args)
+        @param concurrency: max concurrent calls of this batch, default is max_workers
+        @param timeout: deadline seconds of every call, default is configured timeouts
+        @return: results in order of calls, exception instance for the failed call
+        @use:
+            user, msg = client.batch([(UserService, "get", (42,)), 
+                                      (MessageService, "sendSMS", ('10086',))])
+        """
+        calls = list(calls)
+        results = [None] * len(calls)
+        pending = deque(range(len(calls)))
+        kwargs = {} if timeout is None else {"timeout":timeout}
+        def work():
+            while True:
+                try:
+                    i = pending.popleft()
+                except IndexError:
+                    return
+                skey, fun, args = calls[i]
+                try:
+                    results[i] = self.call(skey, fun, *args, **kwargs)
+                except Exception as e:
+                    results[i] = e
+        
+        workers = min(concurrency or self.__max_workers, len(calls))
+        if workers <= 0:
+            return results
+        #调用者自己也处理请求，executor满时不会死锁
+        futures = [self.get_executor().submit(work) for _ in range(workers - 1)]
+        work()
+        #队列已取空，取消还未开始的worker，只等待正在处理请求的worker，
+        #调用者本身在executor中运行时不会等待排在它后面的worker
+        for future in futures:
+            if not future.cancel():
+                future.result()
+        return results
+    
+    def map(self, skey, fun, args_list, concurrency=None, timeout=None):
+        """
+        call one service function concurrently with every args
+        @param skey: service module or module name
+        @param fun: service function or function name
+        @param args_list: args of every call, tuple or single arg
+        @param concurrency: max concurrent calls, default is max_workers
+        @param timeout: deadline seconds of every call, default is configured timeouts
+        @use:
+            users = client.map(UserService, "get", [1, 2, 3])
+        """
+        return self.batch([(skey, fun, args if isinstance(args, tuple) else (args,)) 
+                           for args in args_list], concurrency, timeout)
+    
 class ClientPool(object):
-    """client pool"""
+    """client pool, keyed by (service name, server node) or server node if transport is shared"""
     
-    def __init__(self, client_factory, **kwargs):
-        self.pool = KeyedObjectPool(client_factory.create, **kwargs)
+    def __init__(self, client_factory, share_transport=False, **kwargs):
+        self.share_transport = share_transport
+        self.client_factory = client_factory
+        self.pool = client_factory.pool_class(client_factory.create, 
+                                              validator=client_factory.validate, **kwargs)
             
     def get_pool(self):
         return self.pool
+    
+    def get_key(self, service_name, node):
+        return node if self.share_transport else (service_name, node)
  
     def clear_pool(self):
         self.pool.clear() 
         logger.info("Client pool cleared.")  
         
+    def remove_nodes(self, nodes):
+        """
+        close connections to removed server nodes
+        @param nodes: server nodes
+        """
+        for key in self.pool.keys():
+            node = key if self.share_transport else key[1]
+            if node in nodes:
+                self.pool.remove(key)
+        logger.info("Client pool removed nodes: %s.", list(nodes))
+        
+    def close(self):
+        self.pool.close()
+        
+    def stats(self):
+        return self.pool.stats()
+        
 class ClientProxy(Proxy):
     '''client proxy class'''
     
-    def __init__(self, service_name, pool, retry, retry_interval): 
+    def __init__(self, service_name, pool, provider, retry, retry_interval, 
+                 timeout=None, method_timeouts=None, retry_max_interval=2, retry_budget=None,
+                 idempotent=True, method_idempotents=None, hedge=None, method_hedges=None,
+                 hedge_budget=None, get_executor=None, get_hedge_executor=None, breaker=None, 
+                 caches=None, flights=None): 
         '''
         @param service: service name
         @param pool: client pool  
+        @param provider: server provider, selects server node for every call
         @param retry: retry access times, default is 3
-        @param retry_interval: retry interval time, default 0.2s        
+        @param retry_interval: base retry interval time, default 0.2s        
+        @param timeout: deadline seconds of call, default is None means forever
+        @param method_timeouts: deadline seconds per function as {function name:seconds}
+        @param retry_max_interval: max retry interval time, default is 2s
+        @param retry_budget: RetryBudget shared by the client, None means no limit
+        @param idempotent: retry functions after request sent, default is True
+        @param method_idempotents: idempotent per function as {function name:bool}
+        @param hedge: hedge delay of all functions, seconds or percentile like 'p95', 
+                      default is None means no hedging
+        @param method_hedges: hedge delay per function as {function name:delay}
+        @param hedge_budget: RetryBudget of hedged requests shared by the client
+        @param get_executor: function returning executor refreshing stale cached results
+        @param get_hedge_executor: function returning executor running hedged requests only, 
+                                   they never wait for tasks of the same executor
+        @param breaker: CircuitBreaker shared by the client, None means no ejection
+        @param caches: ResultCache per function as {function name:cache}
+        @param flights: SingleFlight per function as {function name:single flight}
         '''
         self.service_name = service_name
         self.pool = pool   
+        self.object_pool = pool.get_pool()
+        self.provider = provider
         self.retry = retry
         self.retry_interval = retry_interval
+        self.timeout = timeout
+        self.method_timeouts = method_timeouts or {}
+        self.retry_max_interval = retry_max_interval
+        self.retry_budget = retry_budget
+        self.idempotent = idempotent
+        self.method_idempotents = method_idempotents or {}
+        self.hedge = hedge
+        self.hedge_policies = {fun:HedgePolicy(delay) for fun, delay in (method_hedges or {}).items()}
+        self.hedge_budget = hedge_budget
+        self.get_executor = get_executor
+        self.get_hedge_executor = get_hedge_executor
+        self.breaker = breaker
+        self.caches = caches or {}
+        self.flights = flights or {}
 
-    def call(self, fun, *args):
+    @staticmethod
+    def _remaining(deadline):
+        if deadline is None:
+            return None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise WrpcTimeoutException("Call timeout!")
+        return remaining
+
+    def call(self, fun, *args, **kwargs):
         '''
         @param fun: function name
         @param args: args of service function        
+        @param kwargs:
+            timeout: deadline seconds of this call
+            route_key: routing key of this call, selects node of the first attempt
         '''
-        key = self.service_name
+        cache = self.caches.get(fun)
+        flight = self.flights.get(fun)
+        if cache is None and flight is None:
+            return self._call(fun, args, kwargs)
+        
+        key = (cache or flight).make_key(args)
+        if cache is not None:
+            #命中缓存时不借用连接，也不需要反序列化
+            value, state = cache.get(key)
+            if state == FRESH:
+                return value
+            if state == STALE:
+                if cache.revalidate(key):
+                    self.get_executor().submit(self._refresh, cache, key, fun, args, kwargs)
+                return value
+            generation = cache.generation
+        if flight is not None:
+            #相同参数的调用正在进行时等待其结果
+            timeout = kwargs.get("timeout", self.method_timeouts.get(fun, self.timeout))
+            result = flight.do(key, timeout, self._call, fun, args, kwargs)
+        else:
+            result = self._call(fun, args, kwargs)
+        if cache is not None:
+            cache.put(key, result, generation)
+        return result
+
+    def _refresh(self, cache, key, fun, args, kwargs):
+        generation = cache.generation
+        try:
+            cache.put(key, self._call(fun, args, kwargs), generation)
+        except Exception:
+            cache.revalidate_failed(key)
+            logger.exception("Refresh cache of %s.%s error!", self.service_name, fun)
+
+    def invalidate(self, fun=None, *args):
+        """
+        remove cached results
+        @param fun: function name, default is None means all functions
+        @param args: args of the cached call, default is empty means all results of function
+        """
+        caches = self.caches.values() if fun is None else [self.caches.get(fun)]
+        for cache in caches:
+            if cache is not None:
+                cache.invalidate(cache.make_key(args) if args else None)
+
+    def _call(self, fun, args, kwargs):
+        timeout = kwargs.get("timeout", self.method_timeouts.get(fun, self.timeout))
+        #deadline包括借用连接、建立连接、读取响应及重试的时间
+        deadline = None if timeout is None else time.monotonic() + timeout
+        policy = self.hedge_policies.get(fun)
+        if policy is None and self.hedge is not None:
+            policy = self.hedge_policies.setdefault(fun, HedgePolicy(self.hedge))
+        route_key = kwargs.get("route_key")
+        if policy is not None:
+            return self._hedge(policy, fun, args, deadline, route_key)
+        return self._invoke(fun, args, deadline, None, route_key)
+
+    def _observed(self, policy, fun, args, deadline, tried, route_key=None):
+        start = time.monotonic()
+        result = self._invoke(fun, args, deadline, tried, route_key)
+        policy.observe(time.monotonic() - start)
+        return result
+
+    def _hedge(self, policy, fun, args, deadline, route_key=None):
+        """
+        send a duplicate request to another node if the first one has no reply in the delay,
+        the first successful reply wins and the other one is discarded
+        """
+        #每次调用存入对冲预算，对冲请求最多为调用数的一定比例
+        self.hedge_budget.deposit()
+        #两个请求共享已选节点，对冲请求会选择其他节点
+        tried = set()
+        delay = policy.delay()
+        if delay is None:
+            return self._observed(policy, fun, args, deadline, tried, route_key)
+        if deadline is not None:
+            delay = min(delay, max(deadline - time.monotonic(), 0))
+        
+        executor = self.get_hedge_executor()
+        done = self.pool.client_factory.event_class()
+        first = executor.submit(self._observed, policy, fun, args, deadline, tried, route_key)
+        first.add_done_callback(lambda future: done.set())
+        if done.wait(delay) or not self.hedge_budget.withdraw():
+            return first.result()
+        
+        second = executor.submit(self._observed, policy, fun, args, deadline, tried, route_key)
+        second.add_done_callback(lambda future: done.set())
+        while True:
+            done.clear()
+            for future in (first, second):
+                if future.done() and future.exception() is None:
+                    return future.result()
+            if first.done() and second.done():
+                return first.result()
+            done.wait()
+
+    def _invoke(self, fun, args, deadline, tried=None, route_key=None):
+        """
+        call function with retries
+        @param tried: nodes selected by other requests of the call, retries avoid them
+        @param route_key: routing key selecting node of the first attempt
+        """
         exception = None
-        for _ in range(self.retry):
-            obj = None
-            flag = True
+        object_pool = self.object_pool
+        provider = self.provider
+        budget = self.retry_budget
+        breaker = self.breaker
+        if budget is not None:
+            budget.deposit()
+        for attempt in range(self.retry):
+            if attempt > 0:
+                #重试受预算限制，最后一次失败后不再等待
+                if budget is not None and not budget.withdraw():
+                    break
+                interval = backoff(attempt - 1, self.retry_interval, self.retry_max_interval)
+                if deadline is not None:
+                    interval = min(interval, max(deadline - time.monotonic(), 0))
+                self.pool.client_factory.sleep(interval)
+            obj = node = None
+            sent = False
             try:
-                obj = self.pool.get_pool().borrow_obj(key)
-                if not hasattr(obj, fun):
+                #load balance on every call, connections are pooled per server node,
+                #retries go to other nodes
+                if route_key is not None and not tried:
+                    node = provider.select(route_key)
+                    #路由到的节点被摘除时换用其他节点
+                    if breaker is not None and not breaker.allow(node):
+                        node = breaker.select(tried)
+                elif breaker is not None:
+                    node = breaker.select(tried)
+                else:
+                    node = provider.select() if not tried else select_other(provider, tried)
+                if tried is not None:
+                    tried.add(node)
+                #负载均衡统计节点上进行中的调用及延迟
+                provider.start(node)
+                selected = time.monotonic()
+                key = self.pool.get_key(self.service_name, node)
+                obj = object_pool.borrow_obj(key, self._remaining(deadline))
+                client = obj.get_client(self.service_name, self._remaining(deadline))
+                func = getattr(client, fun, None)
+                if func is None:
                     raise WrpcException("Unknown method!")
-                
-                func = getattr(obj, fun)
-                return func(*args)
-            except TTransportException as e:
-                exception = e
-                flag = False
-                logger.error("Could not connect server!")
+                sent = True
+                start = time.monotonic()
+                result = func(*args)
             except Exception as e:
                 exception = e
-                flag = False
-            finally:
+                error = classify(e)
+                if node is not None:
+                    provider.finish(node, time.monotonic() - selected, error != APPLICATION_ERROR)
+                if breaker is not None and node is not None:
+                    #服务端返回的异常说明节点可用，等待连接池超时不算节点故障
+                    if error == APPLICATION_ERROR:
+                        if sent:
+                            breaker.success(node, time.monotonic() - start)
+                    elif sent or error == TRANSPORT_ERROR:
+                        breaker.failure(node)
                 if obj is not None:
-                    if flag:
-                        self.pool.get_pool().return_obj(obj, key)  
+                    #服务端返回的异常不影响连接，其他错误后连接可能已不同步
+                    if is_reusable(e):
+                        object_pool.return_obj(obj, key)
                     else:
-                        self.pool.get_pool().destroy_obj(obj, key)      
+                        object_pool.destroy_obj(obj, key)
+                if error == APPLICATION_ERROR:
+                    raise
+                if error == TIMEOUT_ERROR:
+                    logger.error("Call %s.%s timeout!", self.service_name, fun)
+                    if not isinstance(e, WrpcTimeoutException):
+                        exception = WrpcTimeoutException("Call timeout!")
+                    if deadline is not None and deadline <= time.monotonic():
+                        raise exception
+                else:
+                    logger.error("Could not connect server!")
+                #请求已发出时只重试幂等方法，未发出(如连接失败)总是可以重试
+                if (sent and not is_unsent(e) 
+                    and not self.method_idempotents.get(fun, self.idempotent)):
+                    raise exception
+            else:
+                provider.finish(node, time.monotonic() - selected)
+                if breaker is not None:
+                    breaker.success(node, time.monotonic() - start)
+                object_pool.return_obj(obj, key)
+                return result
             
-            time.sleep(self.retry_interval)                
+            tried = tried if tried is not None else set()
+            tried.add(node)
         raise exception   
     
\ No newline at end of file
@@ -6,27 +6,142 @@ Created on 2017年3月14日
 @author: shuai.chen
 '''
 
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from functools import partial
+import threading
+import time
 from abc import ABCMeta, abstractmethod
 
+import gevent
+import gevent.event
+
 from thrift.protocol import TCompactProtocol
 from thrift.protocol import TMultiplexedProtocol
 from thrift.transport import TSocket, TTransport
 
+from wrpc.common.multiplex import DeadlineMultiplexedProtocol
+from wrpc.common.node import ServerNode
+from wrpc.common.pool import KeyedObjectPool, KeyedSharedObjectPool
+from wrpc.common.gpool import GeventKeyedObjectPool, GeventExecutor
+from .pipeline import PipelinedConnection
+from .gsocket import GeventSocket
+
 logger = logging.getLogger(__name__)
 
+def run_in_threads(func, args_list):
+    """run func with every args concurrently and wait for all"""
+    threads = [threading.Thread(target=func, args=args) for args in args_list]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def run_in_greenlets(func, args_list):
+    gevent.joinall([gevent.spawn(func, *args) for args in args_list])
+
+class ThriftConnection(object):
+    """
+    framed compact connection to a server node, 
+    its multiplexed service clients share the same transport
+    """
+    
+    socket_class = TSocket.TSocket
+    
+    def __init__(self, server_node, ifaces, propagate_deadline=False):
+        """
+        @param server_node: server node
+        @param ifaces: ifaces map as {iface name: iface class}         
+        @param propagate_deadline: send deadline of call to server, default is False
+        """
+        self.server_node = server_node
+        self.tsocket = self.socket_class(server_node.address, server_node.port)  
+        self.transport = TTransport.TFramedTransport(self.tsocket)
+        self.protocol = TCompactProtocol.TCompactProtocol(self.transport)  
+        self.__ifaces = ifaces
+        self.__clients = {}
+        self.__protocols = {}
+        self.__propagate_deadline = propagate_deadline
+        self.__timeout = None
+        
+    def open(self, timeout=None):
+        """
+        @param timeout: connect timeout seconds, None means blocking
+        """
+        self.set_timeout(timeout)
+        self.transport.open()
+        
+    def is_open(self):
+        return self.tsocket.isOpen()
+    
+    def set_timeout(self, timeout):
+        """
+        set socket timeout of connect and read
+        @param timeout: seconds, None means blocking
+        """
+        if timeout != self.__timeout:
+            self.tsocket.setTimeout(None if timeout is None else timeout * 1000)
+            self.__timeout = timeout
+    
+    def get_client(self, service_name, timeout=None):
+        """
+        get thrift client of service, created once per connection
+        @param service_name: service name
+        @param timeout: remaining seconds of call, None means no deadline
+        """
+        client = self.__clients.get(service_name)
+        if client is None:
+            if self.__propagate_deadline:
+                mprotocol = DeadlineMultiplexedProtocol(self.protocol, service_name)
+                self.__protocols[service_name] = mprotocol
+            else:
+                mprotocol = TMultiplexedProtocol.TMultiplexedProtocol(self.protocol, service_name)  
+            client = getattr(self.__ifaces.get(service_name), "Client")(mprotocol)
+            self.__clients[service_name] = client
+        self.set_timeout(timeout)
+        if self.__propagate_deadline:
+            self.__protocols[service_name].set_timeout(timeout)
+        return client
+        
+    def close(self):
+        try:
+            self.transport.close()
+            logger.info("Client closed.") 
+        except:
+            logger.error("Client close error!")   
+
 class ClientFactory(object):    
     """abstract class of client factory"""
     __metaclass__ = ABCMeta
     
+    #pool class of created connections, 
+    #KeyedSharedObjectPool if connections are shared by concurrent calls
+    pool_class = KeyedObjectPool
+    #blocking helpers of the client, gevent factory replaces them by cooperative ones
+    sleep = staticmethod(time.sleep)
+    run_all = staticmethod(run_in_threads)
+    event_class = threading.Event
+    #connect timeout seconds if connection is created without deadline of call, set by client
+    connect_timeout = None
+    #send deadline of call to server, set by client
+    propagate_deadline = False
+    
     @abstractmethod
-    def create(self, key):
+    def create(self, key, timeout=None):
         raise NotImplementedError
+    
+    def validate(self, obj):
+        """return False if the pooled client is broken"""
+        return True
+    
+    def create_executor(self, max_workers):
+        """executor running concurrent calls of the client"""
+        return ThreadPoolExecutor(max_workers, thread_name_prefix="wrpc-client")
             
 class ThriftClientFactory(ClientFactory):
     """thrift client factory"""
     
+    connection_class = ThriftConnection
+    
     def __init__(self, provider, ifaces):
         """
         @param provider: server provider,instance of AutoProvider or FixedProvider class
@@ -35,30 +150,50 @@ class ThriftClientFactory(ClientFactory):
         self.__provider = provider
         self.__ifaces = ifaces
     
-    def create(self, key):
-        server_node = self.__provider.select()
-        tsocket = TSocket.TSocket(server_node.address, server_node.port)  
-        transport = TTransport.TFramedTransport(tsocket)
-        protocol = TCompactProtocol.TCompactProtocol(transport)  
-        mprotocol = TMultiplexedProtocol.TMultiplexedProtocol(protocol,key)  
-        client = getattr(self.__ifaces.get(key), "Client")
-        transport.open()
-        instance = client(mprotocol)
-        
-        # transport close function
-        def close(self):
-            try:
-                self._iprot.trans.close()
-                self._oprot.trans.close()
-                logger.info("Client closed.") 
-            except:
-                logger.error("Client close error!")   
-             
-        #add close function
-        instance.close = partial(close, instance)    
-        
-        logger.info("Client created.") 
-        return instance
+    def create(self, key, timeout=None):
+        """
+        create connection to the server node
+        @param key: pool key as (service name, server node) or server node if transport is shared
+        @param timeout: connect timeout seconds, default is connect_timeout
+        """
+        server_node = key if isinstance(key, ServerNode) else key[1]
+        connection = self.connection_class(server_node, self.__ifaces, self.propagate_deadline)
+        connection.open(self.connect_timeout if timeout is None else timeout)
+        logger.info("Client created for %s.", server_node) 
+        return connection
+    
+    def validate(self, obj):
+        """
+        check that the peer has not closed the socket, 
+        the socket is closed by isOpen if it gets EOF
+        """
+        return obj.is_open()
+
+class PipelinedClientFactory(ThriftClientFactory):
+    """
+    pipelined client factory, 
+    every connection keeps many requests in flight and is shared by concurrent calls
+    """
+    
+    pool_class = KeyedSharedObjectPool
+    connection_class = PipelinedConnection
+
+class GeventConnection(ThriftConnection):
+    """connection on a cooperative socket, blocking io yields to the gevent hub"""
+    
+    socket_class = GeventSocket
 
 class GeventClientFactory(ThriftClientFactory):
-    """gevent client factory"""
+    """
+    gevent client factory, 
+    connections use cooperative sockets and greenlets wait for them in a gevent pool
+    """
+    
+    pool_class = GeventKeyedObjectPool
+    connection_class = GeventConnection
+    sleep = staticmethod(gevent.sleep)
+    run_all = staticmethod(run_in_greenlets)
+    event_class = gevent.event.Event
+    
+    def create_executor(self, max_workers):
+        return GeventExecutor(max_workers)
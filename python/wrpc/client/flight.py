@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+request coalescing, identical concurrent calls share the reply of one request
+'''
+
+import threading
+
+from wrpc.common import WrpcTimeoutException
+from .cache import make_key
+
+class Flight(object):
+
+    __slots__ = ("event", "result", "exception")
+
+    def __init__(self, event):
+        self.event = event
+        self.result = None
+        self.exception = None
+
+class SingleFlight(object):
+    """
+    single flight of one service function, callers with the same args as a call in flight
+    wait for its result instead of sending another request
+    """
+
+    def __init__(self, args_class, event_class=threading.Event):
+        """
+        @param args_class: generated args struct of the function, such as UserService.get_args
+        @param event_class: event waited by callers, threading.Event or gevent.event.Event
+        """
+        self.args_class = args_class
+        self.event_class = event_class
+        self.__flights = {}
+        self.__coalesced = 0
+        self.__lock = threading.Lock()
+
+    def make_key(self, args):
+        return make_key(self.args_class, args)
+
+    def do(self, key, timeout, func, *args):
+        """
+        call func or wait for the call in flight with the same key
+        @param key: key of args
+        @param timeout: max seconds to wait for the call in flight, None means forever
+        @return: result of func, exception of the call is raised to all callers
+        """
+        with self.__lock:
+            flight = self.__flights.get(key)
+            if flight is None:
+                flight = self.__flights[key] = Flight(self.event_class())
+                leader = True
+            else:
+                self.__coalesced += 1
+                leader = False
+
+        if not leader:
+            if not flight.event.wait(timeout):
+                raise WrpcTimeoutException("Call timeout!")
+            if flight.exception is not None:
+                raise flight.exception
+            return flight.result
+
+        try:
+            flight.result = func(*args)
+            return flight.result
+        except Exception as e:
+            flight.exception = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__flights[key]
+            flight.event.set()
+
+    def stats(self):
+        """
+        @return: {"in_flight":n, "coalesced":n}
+        """
+        return {"in_flight":len(self.__flights), "coalesced":self.__coalesced}
@@ -0,0 +1,21 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+cooperative thrift socket, works without gevent monkey patching
+'''
+
+import gevent.socket
+from thrift.transport import TSocket
+
+class GeventSocket(TSocket.TSocket):
+    """TSocket whose resolving, connecting and io yield to the gevent hub"""
+
+    def _resolveAddr(self):
+        if self._unix_socket is not None:
+            return super(GeventSocket, self)._resolveAddr()
+        return gevent.socket.getaddrinfo(self.host, self.port, self._socket_family,
+                                         gevent.socket.SOCK_STREAM, 0, gevent.socket.AI_PASSIVE)
+
+    def _do_open(self, family, socktype):
+        return gevent.socket.socket(family, socktype)
@@ -0,0 +1,48 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+hedged requests, a duplicate is sent to another node if the reply is late
+'''
+
+from collections import deque
+
+class HedgePolicy(object):
+    """
+    delay of hedged request, fixed seconds or percentile of recent latencies
+    """
+
+    def __init__(self, delay, size=1000, refresh=100):
+        """
+        @param delay: seconds, or percentile string like 'p95' of recent latencies
+        @param size: latencies kept for percentile, default is 1000
+        @param refresh: percentile recomputed every refresh latencies, default is 100
+        """
+        self.fixed = None
+        self.percentile = None
+        if isinstance(delay, str):
+            self.percentile = float(delay.lstrip("pP"))
+        else:
+            self.fixed = delay
+        self.refresh = refresh
+        self.__samples = deque(maxlen=size)
+        self.__count = 0
+        self.__value = None
+
+    def delay(self):
+        """return delay seconds, None if not enough latencies observed"""
+        return self.fixed if self.fixed is not None else self.__value
+
+    def observe(self, seconds):
+        """
+        add latency of a successful call
+        @param seconds: latency seconds
+        """
+        if self.percentile is None:
+            return
+        self.__samples.append(seconds)
+        self.__count += 1
+        if self.__count % self.refresh == 0:
+            samples = sorted(self.__samples)
+            index = min(int(len(samples) * self.percentile / 100.0), len(samples) - 1)
+            self.__value = samples[index]
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+pipelined thrift connection, many requests are in flight on one framed connection
+'''
+from __future__ import absolute_import
+
+from concurrent.futures import Future, TimeoutError
+import functools
+import itertools
+import logging
+import socket
+import struct
+import threading
+
+from thrift.protocol import TCompactProtocol
+from thrift.protocol import TMultiplexedProtocol
+from thrift.transport import TSocket, TTransport
+from thrift.transport.TTransport import TTransportException
+
+from wrpc.common import WrpcException, WrpcTimeoutException
+from wrpc.common.multiplex import DeadlineMultiplexedProtocol
+
+logger = logging.getLogger(__name__)
+
+def encode_request(service_name, client_class, fun, args, seqid, timeout=None):
+    """
+    encode request by the generated send function,
+    errors of encoding such as wrong argument types are raised as WrpcException,
+    the request is encoded in memory so the shared connection is still in sync
+    @param timeout: remaining seconds of call sent to server, None means no deadline
+    @return: (client, frame with length prefix), client decodes the reply later
+    """
+    otrans = TTransport.TMemoryBuffer()
+    if timeout is None:
+        oprot = TMultiplexedProtocol.TMultiplexedProtocol(
+                    TCompactProtocol.TCompactProtocol(otrans), service_name)
+    else:
+        oprot = DeadlineMultiplexedProtocol(TCompactProtocol.TCompactProtocol(otrans), service_name)
+        oprot.set_timeout(timeout)
+    client = client_class(oprot)
+    client._seqid = seqid
+    try:
+        getattr(client, "send_" + fun)(*args)
+    except Exception as e:
+        #编码失败时请求未写入连接，不能当作连接错误销毁共享连接
+        raise WrpcException("Could not encode request: %s" % e)
+    payload = otrans.getvalue()
+    return client, struct.pack("!i", len(payload)) + payload
+
+def is_oneway(client, fun):
+    return not hasattr(client, "recv_" + fun)
+
+def read_seqid(payload):
+    iprot = TCompactProtocol.TCompactProtocol(TTransport.TMemoryBuffer(payload))
+    return iprot.readMessageBegin()[2]
+
+def decode_reply(client, fun, payload):
+    """decode reply by the generated recv function"""
+    client._iprot = TCompactProtocol.TCompactProtocol(TTransport.TMemoryBuffer(payload))
+    return getattr(client, "recv_" + fun)()
+
+class PipelinedConnection(object):
+    """
+    framed compact connection shared by concurrent callers,
+    requests are tagged by seqid and replies are dispatched to callers as they arrive
+    """
+
+    def __init__(self, server_node, ifaces, propagate_deadline=False):
+        """
+        @param server_node: server node
+        @param ifaces: ifaces map as {iface name: iface class}
+        @param propagate_deadline: send deadline of call to server, default is False
+        """
+        self.server_node = server_node
+        self.propagate_deadline = propagate_deadline
+        self.tsocket = TSocket.TSocket(server_node.address, server_node.port)
+        self.__ifaces = ifaces
+        self.__services = {}
+        self.__seqids = itertools.count(1)
+        #{seqid:future}
+        self.__pending = {}
+        self.__lock = threading.Lock()
+        self.__write_lock = threading.Lock()
+        self.__closed = True
+
+    def open(self, timeout=None):
+        """
+        @param timeout: connect timeout seconds, None means blocking
+        """
+        if timeout is not None:
+            self.tsocket.setTimeout(timeout * 1000)
+        self.tsocket.open()
+        #读线程一直阻塞读取，调用超时由future控制
+        self.tsocket.setTimeout(None)
+        self.__closed = False
+        reader = threading.Thread(target=self.__read_loop, name="wrpc-pipeline-reader")
+        reader.daemon = True
+        reader.start()
+
+    def is_open(self):
+        return not self.__closed
+
+    def get_client(self, service_name, timeout=None):
+        """
+        get pipelined client of service
+        @param service_name: service name
+        @param timeout: remaining seconds of call, None means no deadline
+        """
+        if timeout is not None:
+            return PipelinedClient(self, service_name, 
+                                   getattr(self.__ifaces.get(service_name), "Client"), timeout)
+        client = self.__services.get(service_name)
+        if client is None:
+            client = PipelinedClient(self, service_name, getattr(self.__ifaces.get(service_name), "Client"))
+            self.__services[service_name] = client
+        return client
+
+    def invoke(self, service_name, client_class, fun, *args, **kwargs):
+        """
+        send request and wait for its reply
+        @param service_name: service name
+        @param client_class: thrift generated Client class of service
+        @param fun: function name
+        @param args: args of service function
+        @param kwargs:
+            timeout: seconds waiting for reply, None means forever
+        """
+        timeout = kwargs.get("timeout")
+        seqid = next(self.__seqids) & 0x7fffffff
+        client, frame = encode_request(service_name, client_class, fun, args, seqid,
+                                       timeout if self.propagate_deadline else None)
+
+        #oneway function has no reply
+        future = None
+        if not is_oneway(client, fun):
+            future = Future()
+            with self.__lock:
+                if self.__closed:
+                    raise TTransportException(TTransportException.NOT_OPEN, "Connection closed")
+                self.__pending[seqid] = future
+
+        try:
+            with self.__write_lock:
+                self.tsocket.write(frame)
+        except Exception as e:
+            self.__fail(e)
+            raise
+
+        if future is None:
+            return None
+        try:
+            payload = future.result(timeout)
+        except TimeoutError:
+            #迟到的响应由读线程丢弃，连接仍可继续使用
+            with self.__lock:
+                self.__pending.pop(seqid, None)
+            raise WrpcTimeoutException("Call timeout!")
+        return decode_reply(client, fun, payload)
+
+    def __read_loop(self):
+        try:
+            while True:
+                size, = struct.unpack("!i", self.tsocket.readAll(4))
+                frame = self.tsocket.readAll(size)
+                seqid = read_seqid(frame)
+                with self.__lock:
+                    future = self.__pending.pop(seqid, None)
+                if future is not None:
+                    future.set_result(frame)
+        except Exception as e:
+            if not self.__closed:
+                logger.warning("Pipelined connection to %s broken: %s", self.server_node, e)
+            self.__fail(e)
+
+    def __fail(self, e):
+        with self.__lock:
+            self.__closed = True
+            pending, self.__pending = self.__pending, {}
+        if not isinstance(e, TTransportException):
+            e = TTransportException(TTransportException.END_OF_FILE, str(e))
+        for future in pending.values():
+            future.set_exception(e)
+        handle = self.tsocket.handle
+        if handle is not None:
+            #wake up the reader blocked in recv
+            try:
+                handle.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.tsocket.close()
+
+    def close(self):
+        #请求可能已发出，不能用NOT_OPEN，否则非幂等方法会被当作未发出而重试
+        self.__fail(TTransportException(TTransportException.END_OF_FILE, "Connection closed"))
+        logger.info("Client closed.")
+
+class PipelinedClient(object):
+    """service client calling through a pipelined connection"""
+
+    def __init__(self, connection, service_name, client_class, timeout=None):
+        self.__connection = connection
+        self.__service_name = service_name
+        self.__client_class = client_class
+        self.__timeout = timeout
+
+    def __getattr__(self, attr):
+        if not hasattr(self.__client_class, "send_" + attr):
+            raise AttributeError(attr)
+        if self.__timeout is not None:
+            return functools.partial(self.__connection.invoke, self.__service_name,
+                                     self.__client_class, attr, timeout=self.__timeout)
+        #缓存到实例，下次调用不再经过__getattr__
+        func = functools.partial(self.__connection.invoke, self.__service_name,
+                                 self.__client_class, attr)
+        setattr(self, attr, func)
+        return func
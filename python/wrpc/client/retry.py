@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+error classification, retry backoff and retry budget of client
+'''
+
+import random
+import socket
+import threading
+
+from thrift.Thrift import TException
+from thrift.protocol.TProtocol import TProtocolException
+from thrift.transport.TTransport import TTransportException
+
+from wrpc.common import WrpcException, WrpcTimeoutException
+
+#错误分类
+TRANSPORT_ERROR = "transport"
+APPLICATION_ERROR = "application"
+TIMEOUT_ERROR = "timeout"
+
+#重试时最多重新选择几次节点以避开失败的节点
+SELECT_ATTEMPTS = 4
+
+def classify(e):
+    """
+    classify error of call
+    @return: TRANSPORT_ERROR if connection is broken, TIMEOUT_ERROR if deadline exceeded,
+             APPLICATION_ERROR if server handler or client code failed
+    """
+    if isinstance(e, WrpcTimeoutException):
+        return TIMEOUT_ERROR
+    if isinstance(e, TTransportException):
+        return TIMEOUT_ERROR if e.type == TTransportException.TIMED_OUT else TRANSPORT_ERROR
+    if isinstance(e, (TProtocolException, socket.error, EOFError)):
+        return TRANSPORT_ERROR
+    return APPLICATION_ERROR
+
+def is_reusable(e):
+    """
+    return True if connection is still in sync after the error,
+    such as exception replied by server, unknown method or timeout of pipelined call
+    """
+    if isinstance(e, TTransportException):
+        return False
+    return isinstance(e, (TException, WrpcException)) and not isinstance(e, TProtocolException)
+
+def is_unsent(e):
+    """
+    return True if the request was not sent, such as connection was not open,
+    connections fail requests in flight by other errors when closed
+    """
+    return isinstance(e, TTransportException) and e.type == TTransportException.NOT_OPEN
+
+def backoff(attempt, interval, max_interval):
+    """
+    exponential backoff with full jitter
+    @param attempt: retry times so far, from 0
+    @param interval: base interval seconds
+    @param max_interval: max interval seconds
+    @return: random seconds in [0, min(max_interval, interval * 2 ** attempt)]
+    """
+    return random.uniform(0, min(max_interval, interval * (2 ** attempt)))
+
+def select_other(provider, tried):
+    """
+    select server node not tried by this call if possible
+    @param provider: server provider
+    @param tried: nodes failed in this call
+    """
+    node = provider.select()
+    for _ in range(SELECT_ATTEMPTS - 1):
+        if node not in tried:
+            break
+        node = provider.select()
+    return node
+
+class RetryBudget(object):
+    """
+    token bucket of retries shared by all calls of a client,
+    every call deposits ratio token and every retry withdraws one,
+    so retries are at most ratio of calls plus max_tokens burst
+    """
+
+    def __init__(self, ratio=0.1, max_tokens=10):
+        """
+        @param ratio: retries per call, default is 0.1
+        @param max_tokens: max tokens saved, default is 10
+        """
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.__tokens = float(max_tokens)
+        self.__lock = threading.Lock()
+
+    def deposit(self):
+        with self.__lock:
+            self.__tokens = min(self.__tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self):
+        """return False if no token left and the call should not be retried"""
+        with self.__lock:
+            if self.__tokens < 1:
+                return False
+            self.__tokens -= 1
+            return True
+
+    def tokens(self):
+        return self.__tokens
@@ -15,6 +15,9 @@ class WrpcException(Exception):
     def __str__(self):
         return self.message    
     
+class WrpcTimeoutException(WrpcException):
+    """deadline of call or pool wait exceeded"""
+    
 class HandlerException(Exception):  
 
     def __init__(self, class_name):
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+object pools built on gevent primitives,
+waiting borrowers yield to the hub instead of blocking the thread
+'''
+
+from collections import deque
+from concurrent.futures import Executor, Future
+import logging
+
+import gevent
+import gevent.event
+import gevent.lock
+import gevent.pool
+
+from wrpc.common.pool import ObjectPool, KeyedObjectPool
+
+logger = logging.getLogger(__name__)
+
+class Condition(object):
+    """condition variable of greenlets, works with gevent.lock.Semaphore"""
+
+    def __init__(self, lock):
+        self._lock = lock
+        self._waiters = deque()
+
+    def __enter__(self):
+        return self._lock.__enter__()
+
+    def __exit__(self, *args):
+        return self._lock.__exit__(*args)
+
+    def wait(self, timeout=None):
+        waiter = gevent.event.Event()
+        self._waiters.append(waiter)
+        self._lock.release()
+        try:
+            return waiter.wait(timeout)
+        finally:
+            self._lock.acquire()
+            if not waiter.is_set():
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+
+    def notify(self, n=1):
+        while self._waiters and n > 0:
+            self._waiters.popleft().set()
+            n -= 1
+
+    def notify_all(self):
+        self.notify(len(self._waiters))
+
+class GeventObjectPool(ObjectPool):
+    """object pool whose borrowers wait as greenlets"""
+
+    lock_class = gevent.lock.Semaphore
+    condition_class = Condition
+
+class GeventEvictor(object):
+    """greenlet running pool eviction, same interface as Evictor"""
+
+    def __init__(self, pool, interval):
+        self.pool = pool
+        self.interval = interval
+        self.__event = gevent.event.Event()
+        self.__greenlet = None
+
+    def start(self):
+        self.__greenlet = gevent.spawn(self.run)
+
+    def run(self):
+        while not self.__event.wait(self.interval):
+            try:
+                self.pool.evict()
+            except Exception:
+                logger.exception("Pool evict error!")
+
+    def cancel(self):
+        self.__event.set()
+
+class GeventFuture(Future):
+    """future whose result is waited by greenlets"""
+
+    def __init__(self):
+        super(GeventFuture, self).__init__()
+        self._event = gevent.event.Event()
+        self.add_done_callback(lambda future: future._event.set())
+
+    def result(self, timeout=None):
+        self._event.wait(timeout)
+        return super(GeventFuture, self).result(0)
+
+    def exception(self, timeout=None):
+        self._event.wait(timeout)
+        return super(GeventFuture, self).exception(0)
+
+class GeventExecutor(Executor):
+    """executor running at most max_workers greenlets, others are queued"""
+
+    def __init__(self, max_workers):
+        self._semaphore = gevent.lock.Semaphore(max_workers)
+        self._group = gevent.pool.Group()
+
+    def submit(self, fn, *args, **kwargs):
+        future = GeventFuture()
+        def run():
+            with self._semaphore:
+                if not future.set_running_or_notify_cancel():
+                    return
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+        self._group.spawn(run)
+        return future
+
+    def shutdown(self, wait=True, **kwargs):
+        if wait:
+            self._group.join()
+        else:
+            self._group.kill(block=False)
+
+class GeventKeyedObjectPool(KeyedObjectPool):
+    """
+    keyed object pool for gevent,
+    no thread lock is taken so greenlets never block the hub
+    """
+
+    object_pool_class = GeventObjectPool
+    lock_class = gevent.lock.Semaphore
+    evictor_class = GeventEvictor
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+multiplexed protocol and processor carrying the deadline of call,
+message name is 'service:function@timeout' where timeout is remaining milliseconds
+of call when the request is written, server turns it into a local deadline when reading,
+so clocks of servers and clients need not be synchronized
+'''
+
+import logging
+import time
+
+from thrift.Thrift import TApplicationException, TMessageType, TType
+from thrift.protocol import TMultiplexedProtocol
+from thrift.protocol.TProtocol import TProtocolException
+from thrift.TMultiplexedProcessor import TMultiplexedProcessor, StoredMessageProtocol
+
+logger = logging.getLogger(__name__)
+
+DEADLINE_SEPARATOR = "@"
+
+class DeadlineMultiplexedProtocol(TMultiplexedProtocol.TMultiplexedProtocol):
+    """multiplexed protocol appending the deadline of call to message name"""
+
+    def __init__(self, protocol, serviceName):
+        super(DeadlineMultiplexedProtocol, self).__init__(protocol, serviceName)
+        self.deadline = None
+
+    def set_timeout(self, timeout):
+        """
+        @param timeout: remaining seconds of call, None means no deadline
+        """
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+
+    def writeMessageBegin(self, name, type, seqid):
+        if self.deadline is not None and type in (TMessageType.CALL, TMessageType.ONEWAY):
+            #发送剩余毫秒数而不是绝对时间，不受两端时钟偏差影响
+            remaining = max(int((self.deadline - time.monotonic()) * 1000), 0)
+            name = "%s%s%d" % (name, DEADLINE_SEPARATOR, remaining)
+        super(DeadlineMultiplexedProtocol, self).writeMessageBegin(name, type, seqid)
+
+class DeadlineMultiplexedProcessor(TMultiplexedProcessor):
+    """
+    multiplexed processor dropping requests whose deadline passed before processing,
+    messages without deadline are processed as TMultiplexedProcessor does
+    """
+
+    def process(self, iprot, oprot):
+        name, type, seqid = iprot.readMessageBegin()
+        deadline = None
+        index = name.rfind(DEADLINE_SEPARATOR)
+        if index >= 0:
+            #读取时把剩余毫秒数转为本地的deadline
+            try:
+                deadline = time.monotonic() + int(name[index + 1:]) / 1000.0
+            except ValueError:
+                logger.warning("Illegal deadline of request %s, ignored.", name)
+            name = name[:index]
+
+        index = name.find(TMultiplexedProtocol.SEPARATOR)
+        if index < 0:
+            if self.defaultProcessor:
+                return self.defaultProcessor.process(
+                            StoredMessageProtocol(iprot, (name, type, seqid)), oprot)
+            raise TProtocolException(TProtocolException.NOT_IMPLEMENTED,
+                                     "Service name not found in message name: " + name)
+        service_name, call = name[:index], name[index + 1:]
+        processor = self.services.get(service_name)
+        if processor is None:
+            raise TProtocolException(TProtocolException.NOT_IMPLEMENTED,
+                                     "Service name not found: " + service_name)
+
+        if deadline is None or deadline > time.monotonic():
+            return processor.process(StoredMessageProtocol(iprot, (call, type, seqid)), oprot)
+
+        #已超时的请求跳过参数，不执行
+        iprot.skip(TType.STRUCT)
+        iprot.readMessageEnd()
+        logger.debug("Request %s dropped, deadline exceeded.", name)
+        if type == TMessageType.ONEWAY:
+            return
+        x = TApplicationException(TApplicationException.UNKNOWN, "Deadline exceeded")
+        oprot.writeMessageBegin(call, TMessageType.EXCEPTION, seqid)
+        x.write(oprot)
+        oprot.writeMessageEnd()
+        oprot.trans.flush()
@@ -27,6 +27,20 @@ class ServerNode(object):
     def __setitem__(self, name, value):
         setattr(self, name, value) 
         
+    def __eq__(self, other):
+        if not isinstance(other, ServerNode):
+            return False
+        return self.address == other.address and self.port == other.port
+    
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    
+    def __hash__(self):
+        return hash((self.address, self.port))
+    
+    def __repr__(self):
+        return "{0}:{1}:{2}".format(self.address, self.port, self.weight)
+        
     def __transfer(self, node):
         split = node.split(":")
         if len(split) == 2:
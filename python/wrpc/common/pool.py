@@ -6,156 +6,551 @@ Created on 2017年3月6日
 @author: shuai.chen
 '''
 
-from queue import Queue
+from collections import deque
+import itertools
+import logging
 import threading
+import time
+
+from wrpc.common import WrpcTimeoutException
+
+logger = logging.getLogger(__name__)
+
+class PooledObject(object):
+    """idle object with its create and last used time"""
+
+    __slots__ = ("obj", "created", "last_used")
+
+    def __init__(self, obj, created, last_used):
+        self.obj = obj
+        self.created = created
+        self.last_used = last_used
 
 class ObjectPool(object):
     """object pool"""
-    
-    _lock = threading.RLock()
- 
+
+    #锁及条件变量的类型，gevent pool替换为协程原语
+    lock_class = threading.Lock
+    condition_class = threading.Condition
+
     def __init__(self, func, *args, **kwargs):
         """
-        object pool class 
+        object pool class
         @param func: method
-        @param args: parmas of func  
-        @param kwargs: 
-            pool_max_size:  pool max size, default is 8    
-            pool_max_active_size : pool max active size, default is 4    
-            pool_wait_timeout:  pool block time, default is None means forever          
+        @param args: parmas of func
+        @param kwargs:
+            pool_max_total: max objects including idle and borrowed, default is 8,
+                            pool_max_size is an alias of it
+            pool_max_idle: max idle objects, extra returned objects are closed,
+                           default is pool_max_total, pool_max_active_size is an alias of it
+            pool_wait_timeout:  pool block time, default is None means forever
+            pool_min_idle: min idle objects kept by evictor, default is 0
+            pool_max_idle_time: idle seconds before evicted, default is None means never
+            pool_max_lifetime: lifetime seconds of object, default is None means forever
+            pool_test_on_borrow: validate object before borrowed, default is False
+            pool_test_while_idle: validate idle objects by evictor, default is False
+            validator: function to validate object, return False if object is broken
         """
         super(ObjectPool, self).__init__()
         self.func = func
         self.args = args
-        self.max_size = kwargs.get("pool_max_size", 8) #max size per key
-        self.max_active_size = kwargs.get("pool_max_active_size", 4) #max active size per key
+        self.max_total = kwargs.get("pool_max_total", kwargs.get("pool_max_size", 8)) #max total per key
+        self.max_idle = kwargs.get("pool_max_idle", 
+                                   kwargs.get("pool_max_active_size", self.max_total)) #max idle per key
         self.wait_timeout = kwargs.get("pool_wait_timeout")
-        
-        #队列计数
+        self.min_idle = kwargs.get("pool_min_idle", 0)
+        self.max_idle_time = kwargs.get("pool_max_idle_time")
+        self.max_lifetime = kwargs.get("pool_max_lifetime")
+        self.test_on_borrow = kwargs.get("pool_test_on_borrow", False)
+        self.test_while_idle = kwargs.get("pool_test_while_idle", False)
+        self.validator = kwargs.get("validator")
+
+        #对象计数，包括空闲、借出及正在创建的对象
         self.count = 0
-        self.queue = Queue(self.max_size)
-        
+        #创建及销毁的对象总数
+        self.created_count = 0
+        self.destroyed_count = 0
+        #空闲队列，右端为最近归还的对象，借出时后进先出
+        self._idle = deque()
+        #借出对象的创建时间 {id(obj):created}
+        self._borrowed = {}
+        #等待中的借用者数，没有等待者时归还不做notify
+        self._waiting = 0
+        #每个pool独立的锁，只保护计数和空闲队列，不在锁内创建或关闭对象
+        self._lock = self.lock_class()
+        self._available = self.condition_class(self._lock)
+
     def __len__(self):
-        return self.queue.qsize()    
-    
-    def _get_obj(self):
-        return self.func(*self.args)
-    
-    def _close_obj(self, obj):
+        return len(self._idle)
+
+    def _get_obj(self, timeout=None):
+        if timeout is None:
+            return self.func(*self.args)
+        return self.func(*self.args, timeout=timeout)
+
+    @staticmethod
+    def _close_obj(obj):
         if hasattr(obj, "close"):
             try:
-                obj.close()  
+                obj.close()
             except:
-                pass         
-    
-    def __put_obj(self, obj):
+                pass
+
+    def __release(self, num=1, destroyed=True):
         with self._lock:
-            if self.size() < self.max_size:
-                self.queue.put(obj) 
-            else:
-                self._close_obj(obj)
-                del obj  
-            
-    def size(self):
-        return self.queue.qsize()        
-    
-    def clear(self):
+            self.count = max(self.count - num, 0)
+            if destroyed:
+                self.destroyed_count += num
+            self._available.notify(num)
+
+    def __expired(self, entry, now):
+        return self.max_lifetime is not None and now - entry.created >= self.max_lifetime
+
+    def __validate(self, obj):
+        try:
+            return self.validator(obj)
+        except Exception:
+            return False
+
+    def __acquire(self, deadline):
+        """return idle object or None if caller should create a new one"""
         with self._lock:
-            while not self.queue.empty():
-                obj = self.queue.get()
-                self._close_obj(obj) 
-                del obj  
-            self.count = 0         
-    
-    def borrow_obj(self):
+            while not self._idle:
+                if self.count < self.max_total:
+                    #占位后在锁外创建对象
+                    self.count += 1
+                    return None
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise WrpcTimeoutException("Borrow object timeout!")
+                self._waiting += 1
+                try:
+                    self._available.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            entry = self._idle.pop()
+            self._borrowed[id(entry.obj)] = entry.created
+            return entry
+
+    def size(self):
+        return len(self._idle)
+
+    def clear(self, discard_borrowed=False):
+        """
+        close idle objects
+        @param discard_borrowed: close borrowed objects when they are returned
+        """
         with self._lock:
-            if self.queue.empty() and self.count < self.queue.maxsize:
-                self.queue.put(self._get_obj())
-                self.count += 1
-            return self.queue.get(True, self.wait_timeout) 
-    
+            objs = [entry.obj for entry in self._idle]
+            self._idle.clear()
+            num = len(objs)
+            if discard_borrowed:
+                num += len(self._borrowed)
+                self._borrowed.clear()
+            self.count = max(self.count - num, 0)
+            self.destroyed_count += num
+            self._available.notify(num)
+        for obj in objs:
+            self._close_obj(obj)
+
+    def borrow_obj(self, timeout=None):
+        """
+        @param timeout: max seconds of waiting and creating object, passed to func as timeout,
+                        None means waiting pool_wait_timeout
+        """
+        deadline = end = None
+        if self.wait_timeout is not None:
+            deadline = time.monotonic() + self.wait_timeout
+        if timeout is not None:
+            end = time.monotonic() + timeout
+            deadline = end if deadline is None else min(deadline, end)
+
+        while True:
+            entry = self.__acquire(deadline)
+            if entry is None:
+                try:
+                    obj = self._get_obj(None if end is None else max(end - time.monotonic(), 0))
+                except:
+                    self.__release(destroyed=False)
+                    raise
+                with self._lock:
+                    self.created_count += 1
+                    self._borrowed[id(obj)] = time.monotonic()
+                return obj
+
+            obj = entry.obj
+            if (not self.__expired(entry, time.monotonic())
+                and (not self.test_on_borrow or self.validator is None or self.__validate(obj))):
+                return obj
+            #过期或已断开的对象直接销毁，重新获取
+            self.destroy_obj(obj)
+
     def return_obj(self, obj):
-        if self.size() < self.max_active_size:
-            self.__put_obj(obj)    
-        else:
-            self.destroy_obj(obj)    
-            
+        now = time.monotonic()
+        with self._lock:
+            created = self._borrowed.pop(id(obj), None)
+            #不是从当前pool借出的对象，如pool已被清空或移除，在锁外关闭
+            if created is not None:
+                entry = PooledObject(obj, created, now)
+                if not self.__expired(entry, now) and len(self._idle) < self.max_idle:
+                    self._idle.append(entry)
+                    if self._waiting:
+                        self._available.notify()
+                    return
+                self.count = max(self.count - 1, 0)
+                self.destroyed_count += 1
+                if self._waiting:
+                    self._available.notify()
+        self._close_obj(obj)
+
     def destroy_obj(self, obj):
+        if obj:
+            with self._lock:
+                created = self._borrowed.pop(id(obj), None)
+            self._close_obj(obj)
+            del obj
+            if created is not None:
+                self.__release()
+
+    def evict(self):
+        """
+        evict idle objects which are expired, idle too long or broken
+        """
+        now = time.monotonic()
+        evicted, testing = [], []
+        with self._lock:
+            remaining = len(self._idle)
+            survivors = deque()
+            #左端为空闲最久的对象
+            for entry in self._idle:
+                idle_too_long = (self.max_idle_time is not None
+                                 and now - entry.last_used >= self.max_idle_time
+                                 and remaining > self.min_idle)
+                if idle_too_long or self.__expired(entry, now):
+                    evicted.append(entry.obj)
+                    remaining -= 1
+                elif self.test_while_idle and self.validator is not None:
+                    #检测期间不放回空闲队列，避免被借出
+                    testing.append(entry)
+                else:
+                    survivors.append(entry)
+            self._idle = survivors
+            self.count = max(self.count - len(evicted), 0)
+            self.destroyed_count += len(evicted)
+            self._available.notify(len(evicted))
+
+        for obj in evicted:
+            self._close_obj(obj)
+
+        broken = []
+        valid = []
+        for entry in testing:
+            if self.__validate(entry.obj):
+                valid.append(entry)
+            else:
+                broken.append(entry.obj)
+        if valid:
+            with self._lock:
+                self._idle.extendleft(reversed(valid))
+                self._available.notify(len(valid))
+        for obj in broken:
+            self._close_obj(obj)
+        if broken:
+            self.__release(len(broken))
+        return len(evicted) + len(broken)
+
+    def ensure_min_idle(self):
+        """
+        create objects until idle size reaches min idle
+        """
+        return self.prepare(self.min_idle)
+
+    def prepare(self, num):
+        """
+        create objects until idle size reaches num
+        @return: created objects num
+        """
+        with self._lock:
+            need = min(num - len(self._idle), 
+                       self.max_idle - len(self._idle), 
+                       self.max_total - self.count)
+            if need <= 0:
+                return 0
+            self.count += need
+
+        for i in range(need):
+            try:
+                obj = self._get_obj()
+            except Exception as e:
+                self.__release(need - i, destroyed=False)
+                logger.warning("Create idle object error: %s", e)
+                return i
+            now = time.monotonic()
+            with self._lock:
+                self.created_count += 1
+                self._idle.appendleft(PooledObject(obj, now, now))
+                self._available.notify()
+        return need
+
+    def stats(self):
         with self._lock:
-            if obj:
-                self._close_obj(obj)
-                del obj  
-                if self.count > 0:
-                    self.count -= 1               
+            idle = len(self._idle)
+            return {"active":self.count - idle, "idle":idle,
+                    "created":self.created_count, "destroyed":self.destroyed_count}
 
-class KeyedObjectPool(ObjectPool):    
+class SharedObjectPool(object):
     """
-    keyed object pool 
+    pool of objects shared by concurrent borrowers, such as pipelined connections,
+    objects are borrowed round robin and returning is a no-op
     """
-    
-    def __init__(self, func, *args, **kwargs):    
-        super(KeyedObjectPool, self).__init__(func, *args, **kwargs)
-        self.queue_map = {} # {key:{"queue":queue, "count":0}}
-        self.queue = None
-        
+
+    def __init__(self, func, *args, **kwargs):
+        """
+        @param func: method
+        @param args: parmas of func
+        @param kwargs:
+            pool_shared_size: max shared objects, default is 1
+            validator: function to validate object, return False if object is broken
+        """
+        super(SharedObjectPool, self).__init__()
+        self.func = func
+        self.args = args
+        self.max_total = kwargs.get("pool_shared_size", 1)
+        self.validator = kwargs.get("validator")
+
+        self.created_count = 0
+        self.destroyed_count = 0
+        #写时复制，借出时不加锁
+        self._objs = []
+        self._pos = itertools.count()
+        self._lock = threading.Lock()
+        #同一时间只创建一个对象，其他借用者等待或使用已有对象
+        self._create_lock = threading.Lock()
+
     def __len__(self):
-        return sum([v["queue"].qsize() for v in self.queue_map.values()])    
+        return len(self._objs)
 
-    def __contains__(self, key):
-        return key in self.queue_map
-                
-    def __getitem__(self, key):  
-        return self.borrow_obj(key)     
-    
-    def __setitem__(self, key, obj):   
-        self.return_obj(obj, key)   
-            
-    def __check(self, key):
-        if key not in self.queue_map:
-            self.queue_map[key] = {"queue":Queue(self.max_size), "count":0}
-     
-    def __put_obj(self, obj, key):
+    def size(self):
+        return len(self._objs)
+
+    def __add(self, timeout=None):
+        if timeout is None:
+            obj = self.func(*self.args)
+        else:
+            obj = self.func(*self.args, timeout=timeout)
+        with self._lock:
+            self._objs = self._objs + [obj]
+            self.created_count += 1
+        return obj
+
+    def borrow_obj(self, timeout=None):
+        objs = self._objs
+        if len(objs) >= self.max_total:
+            return objs[next(self._pos) % len(objs)]
+
+        if objs and not self._create_lock.acquire(False):
+            return objs[next(self._pos) % len(objs)]
+        if not objs:
+            end = None if timeout is None else time.monotonic() + timeout
+            if not self._create_lock.acquire(True, -1 if timeout is None else timeout):
+                raise WrpcTimeoutException("Borrow object timeout!")
+            if end is not None:
+                timeout = max(end - time.monotonic(), 0)
+        try:
+            objs = self._objs
+            if len(objs) < self.max_total:
+                return self.__add(timeout)
+            return objs[next(self._pos) % len(objs)]
+        finally:
+            self._create_lock.release()
+
+    def return_obj(self, obj):
+        pass
+
+    def destroy_obj(self, obj):
         with self._lock:
-            self.__check(key)
-            if self.size(key) < self.max_size:
-                self.queue_map[key]["queue"].put(obj) 
+            objs = self._objs
+            if not any(o is obj for o in objs):
+                obj = None
             else:
-                self._close_obj(obj) 
-                del obj   
+                self._objs = [o for o in objs if o is not obj]
+                self.destroyed_count += 1
+        if obj is not None:
+            ObjectPool._close_obj(obj)
+
+    def clear(self, discard_borrowed=False):
+        with self._lock:
+            objs, self._objs = self._objs, []
+            self.destroyed_count += len(objs)
+        for obj in objs:
+            ObjectPool._close_obj(obj)
+
+    def evict(self):
+        if self.validator is None:
+            return 0
+        broken = [obj for obj in self._objs if not self.validator(obj)]
+        for obj in broken:
+            self.destroy_obj(obj)
+        return len(broken)
+
+    def ensure_min_idle(self):
+        return 0
+
+    def prepare(self, num):
+        created = 0
+        with self._create_lock:
+            while len(self._objs) < min(num, self.max_total):
+                self.__add()
+                created += 1
+        return created
+
+    def stats(self):
+        return {"active":len(self._objs), "idle":0,
+                "created":self.created_count, "destroyed":self.destroyed_count}
+
+class Evictor(threading.Thread):
+    """background thread running pool eviction"""
+
+    def __init__(self, pool, interval):
+        super(Evictor, self).__init__(name="wrpc-pool-evictor")
+        self.daemon = True
+        self.pool = pool
+        self.interval = interval
+        self.__event = threading.Event()
+
+    def run(self):
+        while not self.__event.wait(self.interval):
+            try:
+                self.pool.evict()
+            except Exception:
+                logger.exception("Pool evict error!")
+
+    def cancel(self):
+        self.__event.set()
+
+class KeyedObjectPool(object):
+    """
+    keyed object pool, every key has its own ObjectPool and lock
+    """
+
+    object_pool_class = ObjectPool
+    lock_class = threading.Lock
+    evictor_class = Evictor
+
+    def __init__(self, func, *args, **kwargs):
+        """
+        @param func: method, called as func(key, *args)
+        @param args: parmas of func
+        @param kwargs: see ObjectPool, and
+            pool_eviction_interval: evictor run interval seconds, default is 30,
+                                    evictor works only if min idle, max idle time, max lifetime
+                                    or test while idle is set
+        """
+        super(KeyedObjectPool, self).__init__()
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.pool_map = {} # {key:ObjectPool}
+        #只在创建子pool时使用
+        self._lock = self.lock_class()
+
+        self.__evictor = None
+        interval = kwargs.get("pool_eviction_interval", 30)
+        if interval and interval > 0 and (kwargs.get("pool_min_idle")
+                                          or kwargs.get("pool_max_idle_time") is not None
+                                          or kwargs.get("pool_max_lifetime") is not None
+                                          or kwargs.get("pool_test_while_idle")):
+            self.__evictor = self.evictor_class(self, interval)
+            self.__evictor.start()
+
+    def __len__(self):
+        return sum([len(pool) for pool in list(self.pool_map.values())])
+
+    def __contains__(self, key):
+        return key in self.pool_map
+
+    def __getitem__(self, key):
+        return self.borrow_obj(key)
+
+    def __setitem__(self, key, obj):
+        self.return_obj(obj, key)
+
+    def _get_pool(self, key):
+        pool = self.pool_map.get(key)
+        if pool is None:
+            with self._lock:
+                pool = self.pool_map.get(key)
+                if pool is None:
+                    args = (key,) + self.args
+                    pool = self.object_pool_class(self.func, *args, **self.kwargs)
+                    self.pool_map[key] = pool
+        return pool
 
     def size(self, key):
-        return self.queue_map[key]["queue"].qsize()
+        pool = self.pool_map.get(key)
+        return pool.size() if pool is not None else 0
 
-    def clear(self):
-        with self._lock:
-            for v in self.queue_map.values():
-                while not v["queue"].empty():
-                    obj = v["queue"].get()
-                    self._close_obj(obj) 
-                    del obj  
-                v["count"]= 0  
-                                
-    def borrow_obj(self, key):
+    def keys(self):
+        return list(self.pool_map.keys())
+
+    def remove(self, key):
+        """
+        remove the pool of key, its borrowed objects are closed when returned
+        """
         with self._lock:
-            self.__check(key)
-            if (self.queue_map[key]["queue"].empty() 
-                and self.queue_map[key]["count"] < self.queue_map[key]["queue"].maxsize):
-                self.args = (key,)
-                self.queue_map[key]["queue"].put(self._get_obj())
-                self.queue_map[key]["count"] += 1
-            return self.queue_map[key]["queue"].get(True, self.wait_timeout) 
-    
+            pool = self.pool_map.pop(key, None)
+        if pool is not None:
+            pool.clear(discard_borrowed=True)
+
+    def clear(self):
+        for pool in list(self.pool_map.values()):
+            pool.clear()
+
+    def close(self):
+        if self.__evictor is not None:
+            self.__evictor.cancel()
+            self.__evictor = None
+        self.clear()
+
+    def evict(self):
+        for pool in list(self.pool_map.values()):
+            pool.evict()
+            pool.ensure_min_idle()
+
+    def stats(self):
+        """
+        pool statistics as {key:{"active":n, "idle":n, "created":n, "destroyed":n}}
+        """
+        return {key:pool.stats() for key, pool in list(self.pool_map.items())}
+
+    def prepare(self, key, num):
+        return self._get_pool(key).prepare(num)
+
+    def borrow_obj(self, key, timeout=None):
+        """
+        @param timeout: max seconds of waiting and creating object, None means pool_wait_timeout
+        """
+        return self._get_pool(key).borrow_obj(timeout)
+
     def return_obj(self, obj, key):
-        if self.size(key) < self.max_active_size:
-            self.__put_obj(obj, key) 
+        pool = self.pool_map.get(key)
+        if pool is not None:
+            pool.return_obj(obj)
         else:
-            self.destroy_obj(obj, key)    
+            ObjectPool._close_obj(obj)
 
     def destroy_obj(self, obj, key):
-        with self._lock:
-            if obj:
-                self._close_obj(obj) 
-                del obj  
-                if self.queue_map[key]["count"] > 0:
-                    self.queue_map[key]["count"] -= 1    
-                
\ No newline at end of file
+        pool = self.pool_map.get(key)
+        if pool is not None:
+            pool.destroy_obj(obj)
+        else:
+            ObjectPool._close_obj(obj)
+
+class KeyedSharedObjectPool(KeyedObjectPool):
+    """
+    keyed pool of shared objects, every key has its own SharedObjectPool
+    """
+
+    object_pool_class = SharedObjectPool
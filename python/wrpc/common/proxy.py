@@ -7,17 +7,54 @@ Created on 2017年4月1日
 '''
 
 import functools
+import inspect
+import logging
 from abc import ABCMeta, abstractmethod
 
+logger = logging.getLogger(__name__)
+
 class Proxy(object):
     """abstract proxy class"""
     
     __metaclass__ = ABCMeta
     
     def __getattr__(self, attr):
+        #stubs are looked up after attributes of proxy, so functions never replace them
+        stubs = self.__dict__.get("_stubs")
+        if stubs is not None:
+            stub = stubs.get(attr)
+            if stub is not None:
+                return stub
         return functools.partial(self.call, attr)
     
+    def bind(self, iface):
+        """
+        bind a call stub for every function of service once, no new partial on every call,
+        stubs are kept apart from attributes of proxy
+        @param iface: service module
+        """
+        stubs = {}
+        for name, _ in inspect.getmembers(iface.Iface, inspect.isfunction):
+            if name.startswith("_"):
+                continue
+            stubs[name] = functools.partial(self.call, name)
+            if name in self.__dict__ or hasattr(type(self), name):
+                logger.warning("Function %s of %s clashes with proxy attribute, "
+                               "call it by client.call instead.", name, iface.__name__)
+        self._stubs = stubs
+        return self
+    
     @abstractmethod
     def call(self, fun, *args):
         raise NotImplementedError
-    
\ No newline at end of file
+
+class RoutedProxy(Proxy):
+    """proxy passing the routing key to every call of the client proxy"""
+    
+    def __init__(self, proxy, route_key):
+        self.proxy = proxy
+        self.route_key = route_key
+        
+    def call(self, fun, *args, **kwargs):
+        kwargs.setdefault("route_key", self.route_key)
+        return self.proxy.call(fun, *args, **kwargs)
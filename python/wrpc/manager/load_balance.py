@@ -6,8 +6,14 @@
 Created on 2017年3月5日
 '''
 
+import bisect
+import hashlib
+import itertools
+import math
+import operator
 import random
 import threading
+import time
 
 from abc import ABCMeta,abstractmethod
 from wrpc.common import WrpcException
@@ -20,14 +26,66 @@ class LoadBalance(object):
     __metaclass__ = ABCMeta
     
     def __init__(self, nodes=[]):
+        self._node_map = {repr(node):node for node in nodes}
         self._nodes = self._transfer(nodes)    
+        self._changed()
     
     @abstractmethod
     def get_node(self):
         raise NotImplementedError
     
+    def get_node_by_key(self, key):
+        """
+        select node for the routing key of call,
+        load balances without key affinity ignore the key
+        """
+        return self.get_node()
+    
+    def start(self, node):
+        """called when a call to the selected node starts"""
+        pass
+    
+    def finish(self, node, latency, failed=False):
+        """
+        called when a call to the node finishes
+        @param latency: seconds of the call
+        @param failed: True if the call failed by transport error or timeout
+        """
+        pass
+    
     def set_nodes(self, nodes):
-        self._nodes = self._transfer(nodes)
+        """
+        update nodes incrementally, 
+        surviving nodes keep their positions and new nodes are inserted randomly
+        """
+        node_map = {repr(node):node for node in nodes}
+        if set(node_map) == set(self._node_map):
+            return
+        
+        survivors = [node for node in self._nodes if repr(node) in node_map]
+        added = [node for name, node in node_map.items() if name not in self._node_map]
+        self._node_map = node_map
+        self._nodes = self._merge(survivors, self._transfer(added))
+        self._changed()
+        
+    def _changed(self):
+        """called after nodes changed, subclasses rebuild their pick state from _nodes"""
+        pass
+        
+    @staticmethod
+    def _merge(nodes, added):
+        """random interleave added into nodes, keep the order of nodes"""
+        merged = []
+        i, j = 0, 0
+        while i < len(nodes) or j < len(added):
+            left, right = len(nodes) - i, len(added) - j
+            if right == 0 or (left > 0 and random.random() * (left + right) < left):
+                merged.append(nodes[i])
+                i += 1
+            else:
+                merged.append(added[j])
+                j += 1
+        return merged
     
     def _transfer(self, nodes):
         node_list = []
@@ -37,35 +95,290 @@ class LoadBalance(object):
         random.shuffle(node_list)        
         return node_list
 
+def _alias_table(weights):
+    """
+    build alias table of weights for O(1) weighted random pick
+    @return: (prob, alias)
+    """
+    size = len(weights)
+    total = float(sum(weights))
+    prob, alias = [1.0] * size, list(range(size))
+    if size > 0 and total > 0:
+        #Vose alias method, 每个槽位保存自身概率及另一个节点
+        scaled = [weight * size / total for weight in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            prob[s], alias[s] = scaled[s], l
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+    return prob, alias
+
+def _alias_pick(prob, alias):
+    """return weighted random index of alias table"""
+    i = int(random.random() * len(prob))
+    return i if random.random() < prob[i] else alias[i]
+
 class RandomLoad(LoadBalance):
     """
-    random load balance
+    weighted random load balance, 
+    picks in O(1) by an alias table instead of a node list expanded by weight
     """
     
+    def _transfer(self, nodes):
+        node_list = list(nodes)
+        random.shuffle(node_list)
+        return node_list
+    
+    def _changed(self):
+        nodes = list(self._nodes)
+        #一次赋值替换，选择时不会读到不一致的状态
+        self._table = (nodes,) + _alias_table([node.weight for node in nodes])
+    
     def get_node(self):
-        if len(self._nodes) <= 0:
+        nodes, prob, alias = self._table
+        size = len(nodes)
+        if size <= 0:
             raise WrpcException("Server not found!")
-        return random.choice(self._nodes)
+        return nodes[_alias_pick(prob, alias)]
   
 class RoundRobinLoad(LoadBalance):
     """
-    round robin load balance
+    round robin load balance,
+    every instance has its own position and picks without lock
     """
     
-    __lock = threading.RLock()
-    
-    __pos = 0
+    def __init__(self, nodes=[]):
+        #next()在GIL下是原子的，多线程选择不需要加锁
+        self._counter = itertools.count()
+        super(RoundRobinLoad, self).__init__(nodes)
     
     def get_node(self): 
-        size = len(self._nodes)
-        if size<= 0:
+        nodes = self._nodes
+        size = len(nodes)
+        if size <= 0:
+            raise WrpcException("Server not found!")
+        return nodes[next(self._counter) % size]
+
+class SmoothRoundRobinLoad(LoadBalance):
+    """
+    smooth weighted round robin load balance as nginx,
+    nodes are interleaved by weight with O(nodes) memory and pick
+    """
+    
+    def __init__(self, nodes=[]):
+        self._lock = threading.Lock()
+        self._table = ([], [], [], 0)
+        super(SmoothRoundRobinLoad, self).__init__(nodes)
+    
+    def _transfer(self, nodes):
+        node_list = list(nodes)
+        random.shuffle(node_list)
+        return node_list
+    
+    def _changed(self):
+        with self._lock:
+            nodes = list(self._nodes)
+            #存活节点保留当前权重
+            old_nodes, _, old_current, _ = self._table
+            old = {repr(node):value for node, value in zip(old_nodes, old_current)}
+            current = [old.get(repr(node), 0) for node in nodes]
+            self._table = (nodes, [node.weight for node in nodes], current, 
+                           sum(node.weight for node in nodes))
+    
+    def get_node(self):
+        with self._lock:
+            nodes, weights, current, total = self._table
+            size = len(nodes)
+            if size <= 0:
+                raise WrpcException("Server not found!")
+            current[:] = map(operator.add, current, weights)
+            best = current.index(max(current))
+            current[best] -= total
+            return nodes[best]
+
+class LeastRequestLoad(LoadBalance):
+    """
+    least outstanding requests load balance by power of two choices,
+    picks the node with less in-flight calls per weight of two nodes sampled by weight,
+    in-flight calls are counted by start and finish from the client
+    """
+    
+    #按权重抽样候选节点，为False时等概率抽样
+    weighted = True
+    
+    def __init__(self, nodes=[]):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        super(LeastRequestLoad, self).__init__(nodes)
+    
+    def _transfer(self, nodes):
+        return list(nodes)
+    
+    def _changed(self):
+        nodes = list(self._nodes)
+        with self._lock:
+            self._in_flight = {node:self._in_flight.get(node, 0) for node in nodes}
+        weights = [float(node.weight or 1) if self.weighted else 1.0 for node in nodes]
+        self._table = (nodes, weights) + _alias_table(weights)
+    
+    def get_node(self):
+        nodes, weights, prob, alias = self._table
+        size = len(nodes)
+        if size <= 0:
+            raise WrpcException("Server not found!")
+        if size == 1:
+            return nodes[0]
+        #候选节点按权重抽样，进行中调用相同时先抽中的节点胜出，空闲时流量仍按权重分配
+        i = _alias_pick(prob, alias)
+        j = _alias_pick(prob, alias)
+        if j == i:
+            #抽中同一节点时从其余节点中取另一个，保证总是比较两个节点
+            j = int(random.random() * (size - 1))
+            if j >= i:
+                j += 1
+        return self._choose(nodes, weights, i, j)
+    
+    def _choose(self, nodes, weights, i, j):
+        """return the less loaded node of nodes[i] and nodes[j]"""
+        in_flight = self._in_flight
+        if in_flight.get(nodes[j], 0) / weights[j] < in_flight.get(nodes[i], 0) / weights[i]:
+            i = j
+        return nodes[i]
+    
+    def start(self, node):
+        with self._lock:
+            #已下线的节点不再统计
+            count = self._in_flight.get(node)
+            if count is not None:
+                self._in_flight[node] = count + 1
+    
+    def finish(self, node, latency, failed=False):
+        with self._lock:
+            count = self._in_flight.get(node)
+            if count:
+                self._in_flight[node] = count - 1
+    
+    def in_flight(self):
+        """@return: {server node:in-flight calls}"""
+        return dict(self._in_flight)
+
+class PeakEwmaLoad(LeastRequestLoad):
+    """
+    latency aware load balance, 
+    cost of node is peak EWMA of latency times in-flight calls, raised by error rate,
+    failed calls count as failure_latency at least,
+    picks the cheaper node of two random nodes so traffic does not herd to one node,
+    registered weights are ignored, latencies are reported by finish from the client
+    """
+    
+    weighted = False
+    #延迟及错误率衰减时间，秒
+    decay_time = 10.0
+    #错误率为1时成本放大的倍数
+    error_penalty = 10.0
+    #失败调用按不低于该值的延迟统计，秒，快速失败的节点不会比正常节点更便宜
+    failure_latency = 1.0
+    #没有延迟数据且有进行中调用的节点的成本
+    penalty = 1e9
+    
+    def __init__(self, nodes=[]):
+        #{server node:[latency, error rate, time]}
+        self._stats = {}
+        super(PeakEwmaLoad, self).__init__(nodes)
+    
+    def _changed(self):
+        super(PeakEwmaLoad, self)._changed()
+        with self._lock:
+            self._stats = {node:self._stats[node] for node in self._in_flight 
+                           if node in self._stats}
+    
+    def _choose(self, nodes, weights, i, j):
+        now = time.monotonic()
+        if self._cost(nodes[j], now) < self._cost(nodes[i], now):
+            i = j
+        return nodes[i]
+    
+    def _cost(self, node, now):
+        pending = self._in_flight.get(node, 0)
+        stat = self._stats.get(node)
+        if stat is None:
+            return self.penalty + pending if pending else 0
+        #未更新的延迟及错误率随时间衰减，慢节点恢复后可以重新获得流量
+        decay = math.exp(-(now - stat[2]) / self.decay_time)
+        return stat[0] * decay * (pending + 1) * (1 + self.error_penalty * stat[1] * decay)
+    
+    def finish(self, node, latency, failed=False):
+        now = time.monotonic()
+        error = 1.0 if failed else 0.0
+        if failed:
+            latency = max(latency, self.failure_latency)
+        with self._lock:
+            count = self._in_flight.get(node)
+            if count is None:
+                return
+            if count:
+                self._in_flight[node] = count - 1
+            stat = self._stats.get(node)
+            if stat is None:
+                self._stats[node] = [latency, error, now]
+                return
+            decay = math.exp(-(now - stat[2]) / self.decay_time)
+            #延迟升高时立即采用峰值，降低时平滑衰减
+            stat[0] = latency if latency > stat[0] else stat[0] * decay + latency * (1 - decay)
+            stat[1] = stat[1] * decay + error * (1 - decay)
+            stat[2] = now
+    
+    def stats(self):
+        """@return: {server node:{"latency":seconds, "error":rate, "in_flight":n}}"""
+        with self._lock:
+            return {node:{"latency":stat[0], "error":stat[1], 
+                          "in_flight":self._in_flight.get(node, 0)}
+                    for node, stat in self._stats.items()}
+
+class ConsistentHashLoad(LeastRequestLoad):
+    """
+    consistent hash load balance with bounded load,
+    calls with the same routing key go to the same node unless its in-flight calls exceed
+    load_factor times of its weighted share, then the next node on the ring is used,
+    every node has the same number of points on the ring, weight only raises its capacity,
+    only about 1/N of keys move when a node joins or leaves,
+    calls without routing key are balanced as LeastRequestLoad
+    """
+    
+    #每个节点在环上的虚拟节点数，与权重无关，环的大小不随权重增长
+    replicas = 160
+    #节点进行中的调用超过按权重分配份额的倍数时溢出到环上下一个节点
+    load_factor = 1.25
+    
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(value.encode("utf-8")).hexdigest()[:16], 16)
+    
+    def _changed(self):
+        super(ConsistentHashLoad, self)._changed()
+        nodes, weights = self._table[0], self._table[1]
+        points = []
+        for node in nodes:
+            #只用地址计算哈希，权重变化不影响其他节点的位置
+            name = "%s:%s" % (node.address, node.port)
+            points.extend((self._hash("%s-%d" % (name, i)), node) for i in range(self.replicas))
+        points.sort(key=lambda point: point[0])
+        self._ring = ([point[0] for point in points], [point[1] for point in points], 
+                      dict(zip(nodes, weights)), sum(weights))
+    
+    def get_node_by_key(self, key):
+        hashes, ring_nodes, weights, total_weight = self._ring
+        if not hashes:
             raise WrpcException("Server not found!")
-                 
-        with self.__lock:
-            if self.__pos >= size:
-                self.__pos = 0
-                
-            node = self._nodes[self.__pos]  
-            self.__pos += 1
-            return node
-                        
\ No newline at end of file
+        index = bisect.bisect(hashes, self._hash(str(key)))
+        in_flight = self._in_flight
+        #每单位权重可承载的进行中调用数
+        capacity = (sum(in_flight.values()) + 1) * self.load_factor / total_weight
+        length = len(hashes)
+        for step in range(length):
+            node = ring_nodes[(index + step) % length]
+            if in_flight.get(node, 0) < math.ceil(capacity * weights[node]):
+                return node
+        return ring_nodes[index % length]
@@ -25,19 +25,47 @@ class Provider(object):
     __metaclass__ = ABCMeta
     
     @abstractmethod
-    def select(self):
+    def select(self, key=None):
+        """
+        select server node
+        @param key: routing key of call, used by load balance with key affinity
+        """
         raise NotImplementedError
 
     @abstractmethod
     def get_services(self):
         raise NotImplementedError
     
+    @abstractmethod
+    def get_nodes(self):
+        raise NotImplementedError
+    
     def listen(self):
         pass
     
+    def wait_ready(self, timeout=None):
+        """
+        wait until server nodes are known
+        @param timeout: seconds, None means forever
+        @return: True if ready
+        """
+        return True
+    
     def set_client_pool(self, client_pool):
         pass
     
+    def start(self, node):
+        """called by client when a call to the selected node starts"""
+        pass
+    
+    def finish(self, node, latency, failed=False):
+        """
+        called by client when a call to the node finishes
+        @param latency: seconds of the call
+        @param failed: True if the call failed by transport error or timeout
+        """
+        pass
+    
     def close(self):
         pass   
 
@@ -53,7 +81,9 @@ class AutoProvider(Provider):
         @param global_service_name: global service name
         @param version: server version default is 1.0.0
         @param services: service ifaces class
-        @param load_balance: load balance class, RoundRobinLoad or RandomLoad, 
+        @param load_balance: load balance class, RoundRobinLoad, SmoothRoundRobinLoad, RandomLoad,
+                             LeastRequestLoad, PeakEwmaLoad 
+                             or ConsistentHashLoad,
                              default is RoundRobinLoad
         """
         try:
@@ -69,6 +99,8 @@ class AutoProvider(Provider):
         self.__all_nodes = {}
         self.__live_nodes = set()  
         self.__client_pool = None
+        #set when the first node snapshot arrives
+        self.__ready = threading.Event()
         
     def __get_parent_path(self):
         zsd = constant.ZK_SEPARATOR_DEFAULT
@@ -82,29 +114,48 @@ class AutoProvider(Provider):
         
     def __watch_server_node(self, nodes):
         with self.__lock:
-            self.__live_nodes.clear()
-            
             if len(nodes) <= 0:
                 logger.warn("server not found!") 
-            else:                
-                for node in nodes:
-                    server_node = ServerNode(node)
-                    self.__all_nodes[node] = server_node
-                    self.__live_nodes.add(server_node)  
                 
-            self.__load_balance.set_nodes(self.__live_nodes)    
+            all_nodes = {}
+            for node in nodes:
+                all_nodes[node] = self.__all_nodes.get(node) or ServerNode(node)
+            live_nodes = set(all_nodes.values())
+            #only connections to removed nodes are closed
+            removed = self.__live_nodes - live_nodes
+            added = live_nodes - self.__live_nodes
+            
+            self.__all_nodes = all_nodes
+            self.__live_nodes = live_nodes
+            self.__load_balance.set_nodes(live_nodes)    
                 
-            if self.__client_pool is not None:
-                self.__client_pool.clear_pool()    
+            if removed and self.__client_pool is not None:
+                self.__client_pool.remove_nodes(removed)    
             
-        logger.info("Child node changed.")        
+        self.__ready.set()
+        logger.info("Child node changed, added: %s, removed: %s.", list(added), list(removed))        
+    
+    def wait_ready(self, timeout=None):
+        return self.__ready.wait(timeout)
+    
+    def select(self, key=None):
+        if key is None:
+            return self.__load_balance.get_node()
+        return self.__load_balance.get_node_by_key(key)
     
-    def select(self):
-        return self.__load_balance.get_node()
+    def start(self, node):
+        self.__load_balance.start(node)
+    
+    def finish(self, node, latency, failed=False):
+        self.__load_balance.finish(node, latency, failed)
     
     def get_services(self):
         return self.__services
     
+    def get_nodes(self):
+        with self.__lock:
+            return list(self.__live_nodes)
+    
     def set_client_pool(self, client_pool):
         self.__client_pool = client_pool
         
@@ -121,7 +172,9 @@ class FixedProvider(Provider):
         fixed server provider
         @param server_address: server adress  as string 'ip:port:weight' or 'ip:port'     
         @param service_ifaces: service ifaces class
-        @param load_balance: load balance class, RoundRobinLoad or RandomLoad, 
+        @param load_balance: load balance class, RoundRobinLoad, SmoothRoundRobinLoad, RandomLoad,
+                             LeastRequestLoad, PeakEwmaLoad 
+                             or ConsistentHashLoad,
                              default is RoundRobinLoad
         """   
         if not util.check_hosts(server_address):
@@ -142,9 +195,20 @@ class FixedProvider(Provider):
         
         self.__load_balance.set_nodes(self.__live_nodes)       
     
-    def select(self):
-        return self.__load_balance.get_node()
+    def select(self, key=None):
+        if key is None:
+            return self.__load_balance.get_node()
+        return self.__load_balance.get_node_by_key(key)
+    
+    def start(self, node):
+        self.__load_balance.start(node)
+    
+    def finish(self, node, latency, failed=False):
+        self.__load_balance.finish(node, latency, failed)
     
     def get_services(self):
         return self.__services
+    
+    def get_nodes(self):
+        return list(self.__live_nodes)
             
\ No newline at end of file
@@ -8,10 +8,13 @@ Created on 2017年3月13日
 
 import logging
 from multiprocessing import Process, Semaphore
+import struct
 
+import gevent.lock
 import gevent.monkey
 import gevent.pool
 from thrift.server.TProcessPoolServer import TProcessPoolServer
+from thrift.transport import TTransport
 
 # patch os.fork
 gevent.monkey.patch_os()
@@ -92,4 +95,53 @@ class GProcessPoolServer(TProcessPoolServer):
 
     def setNumCoroutines(self, num):
         self.numCoroutines = num
-    
\ No newline at end of file
+
+class GPipelinedProcessPoolServer(GProcessPoolServer):
+    """
+    Server processing the requests pipelined on one connection concurrently,
+    replies are written back by seqid as soon as they are ready
+    """
+
+    def __init__(self, *args):
+        GProcessPoolServer.__init__(self, *args)
+        self.numPipelined = 100
+
+    def serveClient(self, client):
+        """Read frames from the client and process every frame in its own greenlet"""
+        lock = gevent.lock.Semaphore()
+        pool = gevent.pool.Pool(self.numPipelined)
+        try:
+            while True:
+                size, = struct.unpack("!i", client.readAll(4))
+                frame = client.readAll(size)
+                pool.spawn(self.processFrame, client, lock, frame)
+        except (TTransport.TTransportException, EOFError):
+            pass
+        except Exception as x:
+            logger.exception(x)
+
+        pool.join()
+        client.close()
+
+    def processFrame(self, client, lock, frame):
+        iprot = self.inputProtocolFactory.getProtocol(TTransport.TMemoryBuffer(frame))
+        otrans = TTransport.TMemoryBuffer()
+        oprot = self.outputProtocolFactory.getProtocol(otrans)
+        try:
+            self.processor.process(iprot, oprot)
+        except Exception as x:
+            logger.exception(x)
+            return
+
+        reply = otrans.getvalue()
+        # oneway request has no reply
+        if not reply:
+            return
+        try:
+            with lock:
+                client.write(struct.pack("!i", len(reply)) + reply)
+        except Exception as x:
+            logger.exception(x)
+
+    def setNumPipelined(self, num):
+        self.numPipelined = num
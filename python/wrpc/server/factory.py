@@ -182,13 +182,15 @@ class GeventProcessPoolServer(ServerFactory):
         except Exception:
             raise
 
-    @staticmethod
-    def __create_server(processor, ip, port):
-        from ._gevent import GProcessPoolServer
+    def __create_server(self, processor, ip, port):
         transport = TSocket.TServerSocket(ip, port)   
         tfactory = TTransport.TFramedTransportFactory()
         pfactory = TCompactProtocol.TCompactProtocolFactory()
-        return GProcessPoolServer(processor, transport, tfactory, pfactory)
+        return self._get_server_class()(processor, transport, tfactory, pfactory)
+    
+    def _get_server_class(self):
+        from ._gevent import GProcessPoolServer
+        return GProcessPoolServer
     
     def start(self):
         if self._server:
@@ -199,4 +201,27 @@ class GeventProcessPoolServer(ServerFactory):
 
     def stop(self):
         if self._server:
-            self._server.stop()   
+            self._server.stop()
+
+class GeventPipelinedProcessPoolServer(GeventProcessPoolServer):
+    """
+    基于gevent的ProcessPoolServer，同一连接上流水线发送的请求并发处理，
+    配合PipelinedClientFactory使用
+    """
+    
+    def __init__(self, processor, ip, port, **kwargs):
+        """
+        gevent pipelined process pool server
+        @param processor: thrift processor object
+        @param ip: ip 
+        @param port: server port
+        @param process_num:  process num
+        @param coroutines_num: gevent coroutines num of connections
+        @param pipeline_num: max requests processed concurrently per connection
+        """   
+        super(GeventPipelinedProcessPoolServer, self).__init__(processor, ip, port, **kwargs)
+        self._server.setNumPipelined(kwargs.get("pipeline_num", 100))
+        
+    def _get_server_class(self):
+        from ._gevent import GPipelinedProcessPoolServer
+        return GPipelinedProcessPoolServer
@@ -7,11 +7,10 @@ Created on 2017年3月4日
 '''
 from __future__ import absolute_import
 
-from thrift import TMultiplexedProcessor
-
 from .factory import ThriftProcessPoolServer
 from wrpc.manager.register import Register
 from wrpc.common import constant, util, HandlerException
+from wrpc.common.multiplex import DeadlineMultiplexedProcessor
 
 class Server(object):
     """server class"""
@@ -43,8 +42,8 @@ class Server(object):
         '''
         get muti processor instance
         '''
-        #muti processor
-        mprocessor = TMultiplexedProcessor.TMultiplexedProcessor()
+        #muti processor, requests expired before processing are dropped
+        mprocessor = DeadlineMultiplexedProcessor()
         #register handlers 
         for handler in self.server_config.get_service_processors():
             #get handler super class
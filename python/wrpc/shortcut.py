@@ -19,12 +19,13 @@ from .server.server import ServerConfig
 
 from .client.factory import ThriftClientFactory
 from .client.client import Client
+from .client.aio import AsyncClient
 
 from .manager.load_balance import RoundRobinLoad
 from .manager.provider import AutoProvider
 from .common import constant
 
-__all__ = ['create_server', 'create_client']
+__all__ = ['create_server', 'create_client', 'create_async_client']
 
 def import_module(cstr):
     """
@@ -67,6 +68,8 @@ def create_server(zk_hosts="", zk_timeout=10, namespace="",
         process_num: server process num default is cpu num
         coroutines_num: gevent coroutines num default is 100 if server_class is GeventProcessPoolServer
                         else ignore that
+        pipeline_num: max requests processed concurrently per connection default is 100 
+                      if server_class is GeventPipelinedProcessPoolServer else ignore that
         threads_num: ThriftNonblockingServer threads num if server_class is ThriftNonblockingServer
                      else ignore that
     """
@@ -100,15 +103,136 @@ def create_client(zk_hosts="", zk_timeout=10, namespace="",
     @param global_service_name: global service name
     @param version: server version default is 1.0.0
     @param services: service interfaces class
-    @param load_balance: load balance class, RoundRobinLoad or RandomLoad, 
+    @param load_balance: load balance class, RoundRobinLoad, SmoothRoundRobinLoad, RandomLoad,
+                         LeastRequestLoad, PeakEwmaLoad 
+                         or ConsistentHashLoad,
                          default is RoundRobinLoad   
-    @param client_class: child class of ClientFactory, default is ThriftClientFactory    
+    @param client_class: child class of ClientFactory, default is ThriftClientFactory,
+                         PipelinedClientFactory keeps many requests in flight on one connection,
+                         GeventClientFactory uses cooperative sockets and a gevent pool    
     @param retry: retry access times, default is 3     
-    @param retry_interval: retry interval time, default 0.2s            
+    @param retry_interval: base retry interval time, doubled every retry with jitter, 
+                           default 0.2s            
     @param kwargs: 
-        pool_max_size: client pool max size, default is 8 
-        pool_max_active_size: client pool max active size, default is 4 
+        ready_timeout: max seconds to wait for the first server nodes, default is 10s
+        prewarm_size: connections opened per service and node before the first call, default is 0
+        max_workers: max concurrent calls of batch and call_async, default is 32
+        timeout: deadline seconds of call including pool wait, connect, read and retries,
+                 default is None means forever
+        timeouts: deadline seconds per service or function as 
+                  {"MessageService":1, "MessageService.sendSMS":0.5}, overrides timeout
+        propagate_deadline: send remaining time of call to server,
+                            server drops expired requests, default is False
+        retry_max_interval: max retry interval time, default is 2s
+        retry_budget: max ratio of retries to calls of the client, None means no limit,
+                      default is 0.1
+        idempotent: retry functions after request sent, otherwise only connect failures 
+                    are retried, application errors are never retried, default is True
+        idempotents: idempotent per service or function as 
+                     {"UserService":True, "UserService.create":False}, overrides idempotent
+        hedges: hedged services or functions as {"UserService.get":0.05, "UserService":"p95"},
+                a duplicate request is sent to another node if no reply in the delay seconds 
+                or the percentile of recent latencies, default is None means no hedging
+        hedge_budget: max ratio of hedged requests to calls, default is 0.1
+        caches: cached services or functions of idempotent reads as {"UserService.get":60},
+                results are cached for the ttl seconds by args, default is None means no cache
+        cache_max_entries: max results cached per function, default is 1000
+        cache_max_bytes: max serialized bytes cached per function, default is None means no limit
+        cache_stale_ttl: seconds an expired result is still returned while refreshed in 
+                         background, default is 0
+        coalesces: coalesced services or functions as {"UserService.get":True}, callers wait 
+                   for the reply of a call in flight with the same args instead of sending 
+                   another request, default is None means no coalescing
+        eject_failures: consecutive transport errors or timeouts to eject a server node from
+                        selection, None means never eject, default is 5
+        eject_time: seconds before an ejected node gets a probe call, doubled on every 
+                    ejection in a row, default is 30s
+        eject_latency_ratio: eject nodes whose average latency is ratio times of the median
+                             of nodes, default is None means never
+        share_transport: services share one connection per node by TMultiplexedProtocol,
+                         pool sizes are per node then, default is False
+        pool_max_total: max connections per service and node, default is 8,
+                        pool_max_size is an alias of it
+        pool_max_idle: max idle connections per service and node, default is pool_max_total,
+                       pool_max_active_size is an alias of it
         pool_wait_timeout: client pool block time, default is None means forever          
+        pool_min_idle: min idle connections per service and node, default is 0
+        pool_max_idle_time: idle seconds before connection closed, default is None means never,
+                            set it below the idle timeout of firewall or NAT
+        pool_max_lifetime: lifetime seconds of connection, default is None means forever
+        pool_test_on_borrow: check connection before borrowed, default is False
+        pool_test_while_idle: check idle connections by evictor, default is False
+        pool_eviction_interval: evictor run interval seconds, default is 30
+        pool_shared_size: connections per service and node if client_class is 
+                          PipelinedClientFactory, default is 1
+    """
+    provider = create_provider(zk_hosts, zk_timeout, namespace, provider_class, server_address, 
+                               global_service_name, version, services, load_balance)
+
+    #client class
+    client_clazz = get_class(client_class)
+    return Client(provider, client_clazz, retry, retry_interval, **kwargs)    
+
+def create_async_client(zk_hosts="", zk_timeout=10, namespace="", 
+                        provider_class=AutoProvider, server_address="", 
+                        global_service_name="", version=constant.VERSION_DEFAULT, 
+                        services=[], load_balance=RoundRobinLoad, 
+                        retry=3, retry_interval=0.2, **kwargs):
+    """
+    create asyncio client, service functions return awaitables
+    @param zk_hosts: zookeeper hosts if provider is AutoProvider else ignore that
+    @param zk_timeout: zookeeper connection timeout if provider is AutoProvider else ignore that   
+    @param namespace: zookeeper chroot if provider is AutoProvider else ignore that    
+    @param provider_class: server provider class, AutoProvider or FixedProvider class,
+                           default is AutoProvider
+    @param server_address: server adress as string 'ip:port:weight' if provider is FixedProvider
+                           else ignore that
+    @param global_service_name: global service name
+    @param version: server version default is 1.0.0
+    @param services: service interfaces class
+    @param load_balance: load balance class, RoundRobinLoad, SmoothRoundRobinLoad, RandomLoad,
+                         LeastRequestLoad, PeakEwmaLoad 
+                         or ConsistentHashLoad,
+                         default is RoundRobinLoad   
+    @param retry: retry access times, default is 3     
+    @param retry_interval: base retry interval time, doubled every retry with jitter, 
+                           default 0.2s            
+    @param kwargs: 
+        ready_timeout: max seconds to wait for the first server nodes, default is 10s
+        timeout: deadline seconds of call including connect and retries, 
+                 default is None means forever
+        timeouts: deadline seconds per service or function as 
+                  {"MessageService":1, "MessageService.sendSMS":0.5}, overrides timeout
+        share_transport: services share one connection per node by TMultiplexedProtocol,
+                         default is False
+        retry_max_interval: max retry interval time, default is 2s
+        retry_budget: max ratio of retries to calls of the client, None means no limit,
+                      default is 0.1
+        idempotent: retry functions after request sent, otherwise only connect failures 
+                    are retried, application errors are never retried, default is True
+        idempotents: idempotent per service or function as 
+                     {"UserService":True, "UserService.create":False}, overrides idempotent
+        eject_failures: consecutive transport errors or timeouts to eject a server node from
+                        selection, None means never eject, default is 5
+        eject_time: seconds before an ejected node gets a probe call, doubled on every 
+                    ejection in a row, default is 30s
+        eject_latency_ratio: eject nodes whose average latency is ratio times of the median
+                             of nodes, default is None means never
+        pool_shared_size: pipelined connections per service and node, default is 1
+    @use:
+        client = create_async_client(**CLIENT_CONFIG)
+        user = await client.get_client(UserService).get(42)
+    """
+    provider = create_provider(zk_hosts, zk_timeout, namespace, provider_class, server_address, 
+                               global_service_name, version, services, load_balance)
+    return AsyncClient(provider, retry, retry_interval, **kwargs)
+
+def create_provider(zk_hosts="", zk_timeout=10, namespace="", 
+                    provider_class=AutoProvider, server_address="", 
+                    global_service_name="", version=constant.VERSION_DEFAULT, 
+                    services=[], load_balance=RoundRobinLoad):
+    """
+    create server provider, see create_client
     """
     #provider class
     provider_clazz = get_class(provider_class)
@@ -126,13 +250,7 @@ def create_client(zk_hosts="", zk_timeout=10, namespace="",
     if provider_clazz == AutoProvider:
         assert zk_hosts
         server_from = ZkClient.make(zk_hosts, zk_timeout, namespace)
-    else:
-        assert server_address  
-        server_from = server_address
-
-    #client class
-    client_clazz = get_class(client_class)
-                            
-    provider = provider_clazz(server_from, global_service_name, version, ifaces, load_balance_class)
-    return Client(provider, client_clazz, retry, retry_interval, **kwargs)    
-    
\ No newline at end of file
+        return provider_clazz(server_from, global_service_name, version, ifaces, load_balance_class)
+    
+    assert server_address  
+    return provider_clazz(server_address, ifaces, load_balance_class)